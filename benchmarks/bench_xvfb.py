@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Copyright (c) 2012-2026 Corey Goldberg
+# SPDX-License-Identifier: MIT
+
+"""Benchmarks for the Xvfb display lifecycle.
+
+Measures how quickly displays can be started and stopped on this host.
+Requires a real Xvfb on PATH and xvfbwrapper installed (i.e. with
+``pip install --editable .``). Results are written as JSON, so they can
+be compared across releases:
+
+    python benchmarks/bench_xvfb.py --iterations 50 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+from xvfbwrapper import Xvfb
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Return latency percentiles (in milliseconds) for a list of samples."""
+    ordered = sorted(samples)
+    if len(ordered) > 1:
+        percentiles = statistics.quantiles(ordered, n=100, method="inclusive")
+    else:
+        percentiles = ordered * 99
+    return {
+        "count": len(ordered),
+        "min": ordered[0],
+        "mean": statistics.fmean(ordered),
+        "p50": percentiles[49],
+        "p90": percentiles[89],
+        "p99": percentiles[98],
+        "max": ordered[-1],
+    }
+
+
+def timed_start_stop(**kwargs: Any) -> dict[str, float]:
+    """Start and stop one display, returning its phase timings."""
+    xvfb = Xvfb(isolate_environ=True, **kwargs)
+    start = time.perf_counter()
+    xvfb.start()
+    start_ms = (time.perf_counter() - start) * 1000
+    xvfb.stop()
+    return {
+        "start_ms": start_ms,
+        "ready_ms": xvfb.timings.ready_ms,
+        "shutdown_ms": xvfb.timings.shutdown_ms,
+    }
+
+
+def bench_cold_start(iterations: int, **kwargs: Any) -> dict[str, Any]:
+    """Latency percentiles of starting and stopping a display."""
+    runs = [timed_start_stop(**kwargs) for _ in range(iterations)]
+    return {key: summarize([run[key] for run in runs]) for key in runs[0]}
+
+
+def bench_cycles(duration: float, **kwargs: Any) -> dict[str, Any]:
+    """Number of start/stop cycles completed per second."""
+    cycles = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        timed_start_stop(**kwargs)
+        cycles += 1
+    elapsed = time.perf_counter() - start
+    return {"cycles": cycles, "seconds": elapsed, "cycles_per_second": cycles / elapsed}
+
+
+def bench_concurrent(
+    executor_class: Callable[..., Any], displays: int, **kwargs: Any
+) -> dict[str, Any]:
+    """Wall time for starting and stopping many displays at once."""
+    start = time.perf_counter()
+    with executor_class(max_workers=displays) as executor:
+        futures = [executor.submit(timed_start_stop, **kwargs) for _ in range(displays)]
+        runs = [future.result() for future in futures]
+    return {
+        "displays": displays,
+        "wall_ms": (time.perf_counter() - start) * 1000,
+        "start_ms": summarize([run["start_ms"] for run in runs]),
+    }
+
+
+def bench_lock_contention(threads: int, locks_per_thread: int) -> dict[str, Any]:
+    """Latency of reserving display numbers from many threads at once.
+
+    No servers are started. Each thread repeatedly reserves a display
+    number in a shared temp directory and releases it.
+    """
+    samples: list[float] = []
+    retries: list[int] = []
+    samples_lock = threading.Lock()
+    with tempfile.TemporaryDirectory() as tempdir:
+
+        def worker(display_range: range | None) -> None:
+            for _ in range(locks_per_thread):
+                xvfb = Xvfb(tempdir=tempdir, display_range=display_range)
+                start = time.perf_counter()
+                xvfb._get_next_unused_display()
+                elapsed = (time.perf_counter() - start) * 1000
+                xvfb._cleanup_lock_file()
+                with samples_lock:
+                    samples.append(elapsed)
+                    retries.append(xvfb.timings.lock_retries)
+
+        results = {}
+        for name, display_range in (
+            ("random", None),
+            ("display_range", range(1000, 1000 + threads)),
+        ):
+            samples.clear()
+            retries.clear()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for future in [
+                    executor.submit(worker, display_range) for _ in range(threads)
+                ]:
+                    future.result()
+            results[name] = {
+                "lock_ms": summarize(samples),
+                "lock_retries": sum(retries),
+            }
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--displays", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        version = metadata.version("xvfbwrapper")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+
+    results = {
+        "xvfbwrapper": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "cold_start": {
+            "polling": bench_cold_start(args.iterations),
+            "displayfd": bench_cold_start(args.iterations, use_displayfd=True),
+        },
+        "cycles": bench_cycles(args.duration, use_displayfd=True),
+        "concurrent_threads": bench_concurrent(
+            ThreadPoolExecutor, args.displays, use_displayfd=True
+        ),
+        "concurrent_processes": bench_concurrent(
+            ProcessPoolExecutor, args.displays, use_displayfd=True
+        ),
+        "lock_contention": bench_lock_contention(args.displays, args.iterations),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with Path(args.output).open("w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# Copyright (c) 2012-2026 Corey Goldberg
+# SPDX-License-Identifier: MIT
+
+
+"""pytest plugin providing headless display fixtures.
+
+Fixtures:
+
+- ``xvfbwrapper_display``: the display shared by the whole session (the
+  default choice)
+- ``xvfbwrapper_session``: the same shared display, as a session scoped
+  fixture
+- ``xvfbwrapper_function``: a new display for each test
+
+With pytest-xdist, every worker process runs its own session, so each
+worker starts one shared display and reuses it for all of its tests.
+
+Display settings are read from the ``xvfbwrapper_width``,
+``xvfbwrapper_height``, ``xvfbwrapper_colordepth`` and ``xvfbwrapper_args``
+ini options. Fixture and option names are prefixed with ``xvfbwrapper_``,
+so they don't clash with other plugins (i.e. pytest-xvfb).
+"""
+
+import time
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from xvfbwrapper import Xvfb
+
+# User property recording the time a test spent waiting for a display
+SETUP_PROPERTY = "xvfbwrapper_setup_ms"
+
+_session_setup_ms = pytest.StashKey[float]()
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    parser.addini("xvfbwrapper_width", "width of Xvfb displays", default="800")
+    parser.addini("xvfbwrapper_height", "height of Xvfb displays", default="680")
+    parser.addini(
+        "xvfbwrapper_colordepth", "color depth of Xvfb displays", default="24"
+    )
+    parser.addini(
+        "xvfbwrapper_args", "extra arguments for Xvfb", type="args", default=[]
+    )
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    config.pluginmanager.register(_SetupReporter(), "xvfbwrapper-reporter")
+
+
+def _start_xvfb(config: pytest.Config) -> tuple["Xvfb", float]:
+    """Start a display configured from ini options.
+
+    Returns the display and the time it took to start, in milliseconds.
+    """
+    # Imported here, so merely having the plugin installed never breaks
+    # pytest on platforms xvfbwrapper doesn't support
+    from xvfbwrapper import Xvfb  # noqa: PLC0415
+
+    xvfb = Xvfb(
+        width=int(config.getini("xvfbwrapper_width")),
+        height=int(config.getini("xvfbwrapper_height")),
+        colordepth=int(config.getini("xvfbwrapper_colordepth")),
+        extra_args=config.getini("xvfbwrapper_args"),
+        # -displayfd if the server supports it, polling otherwise
+        use_displayfd=None,
+    )
+    start = time.perf_counter()
+    xvfb.start()
+    return xvfb, (time.perf_counter() - start) * 1000
+
+
+@pytest.fixture(scope="session")
+def xvfbwrapper_session(request: pytest.FixtureRequest) -> Iterator["Xvfb"]:
+    """A display shared by every test in the session (or xdist worker)."""
+    xvfb, setup_ms = _start_xvfb(request.config)
+    # Charged to the first test that uses the display through
+    # `xvfbwrapper_display`
+    request.config.stash[_session_setup_ms] = setup_ms
+    try:
+        yield xvfb
+    finally:
+        xvfb.stop()
+
+
+@pytest.fixture
+def xvfbwrapper_display(
+    request: pytest.FixtureRequest, xvfbwrapper_session: "Xvfb"
+) -> "Xvfb":
+    """The shared session display, started by the first test that needs it."""
+    setup_ms = request.config.stash.get(_session_setup_ms, None)
+    if setup_ms is not None:
+        del request.config.stash[_session_setup_ms]
+        request.node.user_properties.append((SETUP_PROPERTY, setup_ms))
+    return xvfbwrapper_session
+
+
+@pytest.fixture
+def xvfbwrapper_function(request: pytest.FixtureRequest) -> Iterator["Xvfb"]:
+    """A new display for a single test."""
+    xvfb, setup_ms = _start_xvfb(request.config)
+    request.node.user_properties.append((SETUP_PROPERTY, setup_ms))
+    try:
+        yield xvfb
+    finally:
+        xvfb.stop()
+
+
+class _SetupReporter:
+    """Summarize the time tests spent waiting for displays to start.
+
+    Reports from xdist workers are collected on the controller, so the
+    summary covers every worker.
+    """
+
+    def __init__(self) -> None:
+        self.displays: int = 0
+        self.setup_ms: float = 0.0
+
+    def pytest_runtest_logreport(self, report: pytest.TestReport) -> None:
+        if report.when != "setup":
+            return
+        for name, value in report.user_properties:
+            if name == SETUP_PROPERTY and isinstance(value, float):
+                self.displays += 1
+                self.setup_ms += value
+
+    def pytest_terminal_summary(
+        self, terminalreporter: pytest.TerminalReporter
+    ) -> None:
+        if self.displays:
+            terminalreporter.write_line(
+                f"xvfbwrapper: {self.displays} displays started, "
+                f"{self.setup_ms:.0f} ms of test setup"
+            )
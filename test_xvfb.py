@@ -4,16 +4,48 @@
 
 """Tests for xvfbwrapper."""
 
+import asyncio
+import fcntl
+import gc
+import json
 import os
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import unittest
+import warnings
+import zlib
 from contextlib import suppress
+from pathlib import Path
 from unittest.mock import patch
 
 import psutil
 
-from xvfbwrapper import Xvfb
+from xvfbwrapper import (
+    AsyncXvfb,
+    Xvfb,
+    XvfbCapabilities,
+    XvfbDaemon,
+    XvfbError,
+    XvfbHandle,
+    XvfbLease,
+    XvfbPool,
+    XvfbTimings,
+    _probe_binary,
+    _XConnection,
+    cleanup_stale,
+    find_xvfb,
+    main,
+    probe_xvfb,
+    stop_all,
+)
 
 
 class XvfbCleanTestCase(unittest.TestCase):
@@ -85,6 +117,62 @@ class XvfbCleanTestCase(unittest.TestCase):
             super().tearDown()
 
 
+def connect_x_client(xvfb):
+    """Connect an X client that leaves state behind on the display.
+
+    It creates a window, sets a property on the root window, owns the
+    PRIMARY selection with its window, and makes the root window own the
+    CLIPBOARD selection. Returns the connection and the property's atom.
+    """
+    client = _XConnection(xvfb._display_socket(xvfb.new_display), timeout=5)
+    root = client.roots[0]
+    window = client.resource_base | 1
+    # CreateWindow: 1x1 input/output window, copying depth and visual
+    client.send(1, struct.pack("<IIhhHHHHII", window, root, 0, 0, 1, 1, 0, 0, 0, 0))
+    atom = client.intern_atom("XVFBWRAPPER_TEST")
+    # ChangeProperty: 8-bit STRING (atom 31)
+    client.send(18, struct.pack("<IIIB3xI", root, atom, 31, 8, 4) + b"test")
+    # SetSelectionOwner: PRIMARY (atom 1) at CurrentTime
+    client.send(22, struct.pack("<III", window, 1, 0))
+    clipboard = client.intern_atom("CLIPBOARD")
+    client.send(22, struct.pack("<III", root, clipboard, 0))
+    client.sync()
+    return client, atom
+
+
+def screen_size(xvfb, screen=0):
+    """Return the size of a screen, as seen by X clients."""
+    with _XConnection(xvfb._display_socket(xvfb.new_display), timeout=5) as client:
+        # GetGeometry of the root window
+        data = struct.pack("<I", client.roots[screen])
+        reply = client.reply(client.send(14, data))
+    return struct.unpack_from("<HH", reply, 16)
+
+
+def draw_rectangle(fbdir, x, y, width, height, pixel):
+    """Draw into the framebuffer file of a server started with fbdir."""
+    with Path(fbdir, "Xvfb_screen0").open("r+b") as f:
+        header = struct.unpack(">25I", f.read(100))
+        # Pixels follow the header and the colormap entries
+        offset, bytes_per_line = header[0] + header[19] * 12, header[12]
+        for row in range(y, y + height):
+            f.seek(offset + row * bytes_per_line + x * 4)
+            f.write(pixel * width)
+
+
+def png_chunks(png):
+    """Split PNG image data into a list of (chunk type, data) tuples."""
+    chunks = []
+    offset = 8
+    while offset < len(png):
+        (size,) = struct.unpack_from(">I", png, offset)
+        chunks.append(
+            (png[offset + 4 : offset + 8], png[offset + 8 : offset + 8 + size])
+        )
+        offset += size + 12
+    return chunks
+
+
 # Simulate X11 in case we are running on a Wayland system
 @patch.dict("os.environ", {"XDG_SESSION_TYPE": "x11", "DISPLAY": ":0"})
 class TestXvfb(XvfbCleanTestCase):
@@ -110,6 +198,62 @@ class TestXvfb(XvfbCleanTestCase):
             ):
                 Xvfb()
 
+    def test_xvfb_binary_lookup_is_cached(self):
+        Xvfb()
+        with patch("shutil.which") as which:
+            Xvfb()
+        which.assert_not_called()
+
+    def test_missing_xvfb_binary_is_not_cached(self):
+        xvfb_path = shutil.which("Xvfb")
+        with tempfile.TemporaryDirectory() as bindir:
+            path = Path(bindir, "Xvfb")
+            with patch.dict("os.environ", {"PATH": bindir}):
+                self.assertIsNone(find_xvfb())
+                path.symlink_to(xvfb_path)
+                self.assertEqual(str(path), find_xvfb())
+
+    def test_xvfb_binary(self):
+        with self.assertRaisesRegex(FileNotFoundError, "Could not find NoSuchXvfb"):
+            Xvfb(xvfb_binary="NoSuchXvfb")
+        path = shutil.which("Xvfb")
+        xvfb = Xvfb(xvfb_binary=path)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        self.assertEqual(path, xvfb.xvfb_cmd[0])
+
+    def test_probe_xvfb(self):
+        capabilities = probe_xvfb()
+        self.assertEqual(shutil.which("Xvfb"), capabilities.path)
+        self.assertRegex(capabilities.version, r"X Server \d")
+        self.assertTrue(capabilities.supports("-displayfd"))
+        self.assertTrue(capabilities.supports("+extension"))
+        self.assertFalse(capabilities.supports("-nosuchoption"))
+        with patch("subprocess.run") as run:
+            self.assertIs(capabilities, probe_xvfb())
+        run.assert_not_called()
+        with self.assertRaises(FileNotFoundError):
+            probe_xvfb("NoSuchXvfb")
+
+    def test_probe_xvfb_help_output(self):
+        help_text = (
+            "\nuse: X [:<display>] [option]\n"
+            "-a #                   default pointer acceleration\n"
+            "\n"
+            "[+-]bs                 enable/disable backing store\n"
+            "   \n"
+            "+extension name        enable extension\n"
+            "Xvnc-specific options:\n"
+            "-rfbport port          TCP port for RFB protocol\n"
+        )
+        result = subprocess.CompletedProcess([], 0, stdout="", stderr=help_text)
+        with patch("subprocess.run", return_value=result):
+            capabilities = _probe_binary("/usr/bin/Xvnc", 0)
+        self.assertEqual(
+            frozenset({"-a", "+bs", "-bs", "+extension", "-rfbport"}),
+            capabilities.options,
+        )
+
     def test_default_args(self):
         w = 800
         h = 680
@@ -144,6 +288,19 @@ class TestXvfb(XvfbCleanTestCase):
         self.assertEqual(depth, xvfb.colordepth)
         self.assertEqual(["-screen", "0", f"{w}x{h}x{depth}"], xvfb.extra_xvfb_args)
 
+    def test_screens(self):
+        xvfb = Xvfb(width=640, height=480, screens=3)
+        expected = [
+            *("-screen", "0", "640x480x24"),
+            *("-screen", "1", "640x480x24"),
+            *("-screen", "2", "640x480x24"),
+        ]
+        self.assertEqual(expected, xvfb.extra_xvfb_args)
+
+    def test_invalid_screens(self):
+        with self.assertRaisesRegex(ValueError, "at least 1"):
+            Xvfb(screens=0)
+
     def test_extra_kwargs(self):
         extra_args = ["-nocursor", "+extension", "RANDR"]
         xvfb = Xvfb(extra_args=extra_args)
@@ -151,6 +308,30 @@ class TestXvfb(XvfbCleanTestCase):
             ["-screen", "0", f"{800}x{680}x{24}", *extra_args], xvfb.extra_xvfb_args
         )
 
+    def test_footprint_args(self):
+        xvfb = Xvfb(
+            disable_extensions=["GLX", "Composite"],
+            backing_store=False,
+            max_clients=512,
+            shmem=True,
+        )
+        expected = [
+            *("-extension", "GLX", "-extension", "Composite"),
+            *("-bs", "-maxclients", "512", "-shmem"),
+        ]
+        self.assertEqual(expected, xvfb.extra_xvfb_args[3:])
+        xvfb = Xvfb(disable_extensions="RENDER", backing_store=True)
+        self.assertEqual(["-extension", "RENDER", "+bs"], xvfb.extra_xvfb_args[3:])
+
+    def test_invalid_footprint_args(self):
+        for name in ("", "+GLX", "-GLX", "GLX RENDER"):
+            with self.assertRaisesRegex(ValueError, "Invalid extension name"):
+                Xvfb(disable_extensions=[name])
+        with self.assertRaisesRegex(ValueError, "Invalid max_clients: 100"):
+            Xvfb(max_clients=100)
+        with self.assertRaisesRegex(ValueError, "can't be used together"):
+            Xvfb(shmem=True, fbdir=tempfile.gettempdir())
+
     def test_start(self):
         xvfb = Xvfb()
         self.addCleanup(xvfb.stop)
@@ -178,6 +359,69 @@ class TestXvfb(XvfbCleanTestCase):
         self.assertIsNotNone(xvfb.proc)
         self.assertNotEqual(pid1, pid2)
 
+    @staticmethod
+    def popen_ignoring_sigterm():
+        code = (
+            "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+            "print(flush=True); time.sleep(60)"
+        )
+        proc = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+        proc.stdout.readline()
+        proc.stdout.close()
+        return proc
+
+    def test_stop_kills_after_grace_period(self):
+        xvfb = Xvfb(grace_period=0.2)
+        xvfb.start()
+        xvfb.proc.terminate()
+        xvfb.proc.wait()
+        proc = self.popen_ignoring_sigterm()
+        xvfb.proc = proc
+        start = time.monotonic()
+        xvfb.stop()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(-signal.SIGKILL, proc.returncode)
+        self.assertIsNone(xvfb.proc)
+
+    def test_start_with_process_group(self):
+        xvfb = Xvfb(process_group=True)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        pgid = xvfb.proc.pid
+        self.assertEqual(pgid, os.getpgid(pgid))
+        proc = xvfb.proc
+        xvfb.stop()
+        self.assertIsNotNone(proc.returncode)
+        with self.assertRaises(ProcessLookupError):
+            os.killpg(pgid, 0)
+
+    def test_stop_all(self):
+        xvfbs = [Xvfb(isolate_environ=True, grace_period=0.5) for _ in range(3)]
+        for xvfb in xvfbs:
+            xvfb.start()
+        procs = [xvfb.proc for xvfb in xvfbs]
+        stop_all()
+        for xvfb, proc in zip(xvfbs, procs, strict=True):
+            self.assertIsNone(xvfb.proc)
+            self.assertIsNotNone(proc.returncode)
+
+    def test_stop_all_kills_in_parallel(self):
+        xvfbs = [Xvfb(isolate_environ=True) for _ in range(3)]
+        for xvfb in xvfbs:
+            xvfb.start()
+            xvfb.proc.terminate()
+            xvfb.proc.wait()
+            xvfb.proc = self.popen_ignoring_sigterm()
+        start = time.monotonic()
+        stop_all(timeout=0.5)
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertTrue(all(xvfb.proc is None for xvfb in xvfbs))
+
+    def test_stop_all_restores_display(self):
+        with Xvfb(), Xvfb():
+            stop_all()
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
     def test_stop_if_not_running_doesnt_raise_error(self):
         xvfb = Xvfb()
         xvfb.stop()
@@ -311,12 +555,301 @@ class TestXvfb(XvfbCleanTestCase):
             "bar",
         ]
         with self.assertRaisesRegex(
-            RuntimeError, f"Xvfb display did not open: {expected_cmd_args}"
+            XvfbError, f"Xvfb display did not open: {expected_cmd_args}"
+        ) as cm:
+            xvfb.start()
+        self.assertIsNone(xvfb.proc)
+        self.assertIn("Unrecognized option: -foo", cm.exception.output)
+
+    def test_start_with_displayfd(self):
+        xvfb = Xvfb(use_displayfd=True)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        self.assertIn("-displayfd", xvfb.xvfb_cmd)
+        self.assertIsNotNone(xvfb.new_display)
+        self.assertEqual(f":{xvfb.new_display}", os.environ["DISPLAY"])
+        self.assertIsNotNone(xvfb.proc)
+
+    def test_start_with_displayfd_if_supported(self):
+        xvfb = Xvfb(use_displayfd=None)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        self.assertIn("-displayfd", xvfb.xvfb_cmd)
+        xvfb.stop()
+
+        unsupported = XvfbCapabilities(path="Xvfb", version=None, options=frozenset())
+        xvfb = Xvfb(use_displayfd=None)
+        self.addCleanup(xvfb.stop)
+        with patch("xvfbwrapper.probe_xvfb", return_value=unsupported):
+            xvfb.start()
+        self.assertNotIn("-displayfd", xvfb.xvfb_cmd)
+
+    def test_start_with_displayfd_and_specific_display(self):
+        display_num = 42
+        xvfb = Xvfb(display=display_num, use_displayfd=True)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        self.assertIn(":42", xvfb.xvfb_cmd)
+        self.assertEqual(xvfb.new_display, display_num)
+        self.assertEqual(":42", os.environ["DISPLAY"])
+
+    def test_start_with_displayfd_fails_with_unknown_kwargs(self):
+        xvfb = Xvfb(foo="bar", use_displayfd=True)
+        with self.assertRaisesRegex(XvfbError, "Xvfb did not start") as cm:
+            xvfb.start()
+        self.assertIn("Unrecognized option: -foo", cm.exception.output)
+        self.assertIn("Unrecognized option: -foo", str(cm.exception))
+        self.assertEqual(cm.exception.output, xvfb.output())
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    def test_output_is_bounded(self):
+        # A server printing more than the pipe can hold must not block
+        with tempfile.TemporaryDirectory() as tempdir:
+            binary = Path(tempdir, "Xvfb")
+            binary.write_text(
+                "#!/bin/sh\n"
+                "head -c 1000000 /dev/zero | tr '\\0' x >&2\n"
+                'exec Xvfb "$@"\n'
+            )
+            binary.chmod(0o755)
+            xvfb = Xvfb(xvfb_binary=str(binary), use_displayfd=True)
+            self.addCleanup(xvfb.stop)
+            xvfb.start()
+            self.assertTrue(xvfb.is_alive())
+            xvfb.stop()
+        self.assertEqual("x" * Xvfb.OUTPUT_BUFFER_SIZE, xvfb.output())
+
+    def test_output_is_cleared_on_start(self):
+        xvfb = Xvfb()
+        self.addCleanup(xvfb.stop)
+        xvfb._append_output(b"previous server\n")
+        self.assertEqual("previous server\n", xvfb.output())
+        xvfb.start()
+        self.assertEqual("", xvfb.output())
+
+    def test_start_with_displayfd_timeout(self):
+        xvfb = Xvfb(use_displayfd=True, timeout=0.5)
+        with (
+            patch.object(xvfb, "_wait_for_displayfd", return_value=None),
+            self.assertRaisesRegex(RuntimeError, "Xvfb display did not open"),
         ):
             xvfb.start()
         self.assertIsNone(xvfb.proc)
 
-    def test_get_next_unused_display_does_not_reuse_lock(self):
+    def test_start_many(self):
+        xvfbs = Xvfb.start_many(3, use_displayfd=True, isolate_environ=True)
+        for xvfb in xvfbs:
+            self.addCleanup(xvfb.stop)
+        self.assertEqual(3, len({xvfb.new_display for xvfb in xvfbs}))
+        for xvfb in xvfbs:
+            self.assertTrue(xvfb.is_alive())
+            self.assertIn("-displayfd", xvfb.xvfb_cmd)
+            self.assertEqual(xvfb.display_name, xvfb.env()["DISPLAY"])
+            self.assertGreater(xvfb.timings.ready_ms, 0)
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    def test_start_many_without_displayfd(self):
+        xvfbs = Xvfb.start_many(2, use_displayfd=False, isolate_environ=True)
+        for xvfb in xvfbs:
+            self.addCleanup(xvfb.stop)
+            self.assertTrue(xvfb.is_alive())
+            self.assertNotIn("-displayfd", xvfb.xvfb_cmd)
+
+    def test_start_many_stops_all_on_failure(self):
+        launched = []
+        xvfb_command = Xvfb._xvfb_command
+
+        def fail_second(xvfb, display_fd=None):
+            launched.append(xvfb)
+            cmd = xvfb_command(xvfb, display_fd)
+            return [*cmd, "-foo"] if len(launched) == 2 else cmd
+
+        with (
+            patch.object(Xvfb, "_xvfb_command", autospec=True, side_effect=fail_second),
+            self.assertRaisesRegex(RuntimeError, "Xvfb did not start"),
+        ):
+            Xvfb.start_many(3, use_displayfd=True)
+        self.assertEqual(3, len(launched))
+        for xvfb in launched:
+            self.assertIsNone(xvfb.proc)
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    def test_start_many_releases_locks_on_failure(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            with self.assertRaisesRegex(RuntimeError, "Could not lock display :42"):
+                Xvfb.start_many(2, display=42, tempdir=tempdir)
+            self.assertFalse(Path(tempdir, ".X42-lock").exists())
+            with Xvfb(display=42, tempdir=tempdir) as xvfb:
+                self.assertEqual(42, xvfb.new_display)
+
+    def test_timings(self):
+        xvfb = Xvfb()
+        self.assertEqual(XvfbTimings(), xvfb.timings)
+        xvfb.start()
+        timings = xvfb.timings
+        self.assertGreater(timings.lock_ms, 0)
+        self.assertGreater(timings.spawn_ms, 0)
+        self.assertGreater(timings.ready_ms, 0)
+        self.assertEqual(0, timings.shutdown_ms)
+        xvfb.stop()
+        self.assertGreater(timings.shutdown_ms, 0)
+
+    def test_timings_lock_retries(self):
+        xvfb = Xvfb()
+        self.addCleanup(xvfb.stop)
+        with (
+            patch("xvfbwrapper.randint", side_effect=[11, 22, 33]),
+            patch.object(xvfb, "_local_display_exists", side_effect=lambda d: d < 30),
+        ):
+            xvfb._reserve_display()
+        self.assertEqual(2, xvfb.timings.lock_retries)
+        self.assertEqual(33, xvfb.new_display)
+
+    def test_metrics_callback(self):
+        events = []
+
+        def callback(event, xvfb):
+            events.append((event, xvfb.new_display, xvfb.timings.shutdown_ms))
+
+        with Xvfb(metrics_callback=callback) as xvfb:
+            self.assertEqual([("start", xvfb.new_display, 0)], events)
+        self.assertEqual(2, len(events))
+        event, display, shutdown_ms = events[1]
+        self.assertEqual("stop", event)
+        self.assertEqual(xvfb.new_display, display)
+        self.assertGreater(shutdown_ms, 0)
+
+    def run_in_forked_child(self, func):
+        """Call func in a forked child process, and return its exit status."""
+        with warnings.catch_warnings():
+            # Forking a multithreaded process is deprecated, but safe here
+            warnings.simplefilter("ignore", DeprecationWarning)
+            pid = os.fork()
+        if pid == 0:
+            try:
+                func()
+            finally:
+                os._exit(0)
+        return os.waitpid(pid, 0)[1]
+
+    def test_stop_in_forked_child_leaves_server_running(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir, restart_on_crash=True)
+            self.addCleanup(xvfb.stop)
+            xvfb.start()
+
+            def stop_in_child():
+                xvfb.stop()
+                stop_all()
+
+            self.assertEqual(0, self.run_in_forked_child(stop_in_child))
+            self.assertTrue(xvfb.is_alive())
+            lock_path = Path(tempdir, f".X{xvfb.new_display}-lock")
+            with lock_path.open() as f, self.assertRaises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            xvfb.stop()
+            self.assertFalse(lock_path.exists())
+
+    def test_handle(self):
+        xvfb = Xvfb()
+        self.assertRaisesRegex(RuntimeError, "not running", xvfb.handle)
+        with xvfb:
+            handle = pickle.loads(pickle.dumps(xvfb.handle()))  # noqa: S301
+            self.assertEqual(XvfbHandle(xvfb.new_display), handle)
+            self.assertEqual(f":{xvfb.new_display}", handle.display_name)
+            self.assertEqual(handle.display_name, handle.env()["DISPLAY"])
+        with self.assertRaisesRegex(TypeError, "pass Xvfb.handle"):
+            pickle.dumps(xvfb)
+
+    def test_is_alive(self):
+        xvfb = Xvfb()
+        self.assertFalse(xvfb.is_alive())
+        with xvfb:
+            self.assertTrue(xvfb.is_alive())
+            xvfb.proc.terminate()
+            xvfb.proc.wait()
+            self.assertFalse(xvfb.is_alive())
+
+    def test_crash_callback(self):
+        crashed = threading.Event()
+        crashes = []
+
+        def callback(xvfb, returncode):
+            crashes.append((xvfb, returncode))
+            crashed.set()
+
+        xvfb = Xvfb(crash_callback=callback)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        lock_file = Path(xvfb._lock_display_file.name)
+        xvfb.proc.terminate()
+        self.assertTrue(crashed.wait(5))
+        self.assertEqual(1, len(crashes))
+        self.assertIs(xvfb, crashes[0][0])
+        self.assertIsNotNone(crashes[0][1])
+        # The crashed server was cleaned up
+        self.assertIsNone(xvfb.proc)
+        self.assertEqual(":0", os.environ["DISPLAY"])
+        self.assertFalse(lock_file.exists())
+
+    def test_restart_on_crash(self):
+        crashed = threading.Event()
+        xvfb = Xvfb(restart_on_crash=True, crash_callback=lambda *_: crashed.set())
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        display = xvfb.new_display
+        old_proc = xvfb.proc
+        old_proc.kill()
+        self.assertTrue(crashed.wait(5))
+        self.assertEqual(-signal.SIGKILL, old_proc.returncode)
+        self.assertIsNot(old_proc, xvfb.proc)
+        self.assertEqual(display, xvfb.new_display)
+        self.assertTrue(xvfb.is_alive())
+        self.assertEqual(f":{display}", os.environ["DISPLAY"])
+        monitor_thread = xvfb._monitor_thread
+        xvfb.stop()
+        self.assertFalse(monitor_thread.is_alive())
+
+    def test_restart_on_crash_without_displayfd(self):
+        crashed = threading.Event()
+        unsupported = XvfbCapabilities(path="Xvfb", version=None, options=frozenset())
+        xvfb = Xvfb(restart_on_crash=True, crash_callback=lambda *_: crashed.set())
+        self.addCleanup(xvfb.stop)
+        with patch("xvfbwrapper.probe_xvfb", return_value=unsupported):
+            xvfb.start()
+            display = xvfb.new_display
+            old_proc = xvfb.proc
+            old_proc.kill()
+            self.assertTrue(crashed.wait(5))
+        self.assertIsNot(old_proc, xvfb.proc)
+        self.assertNotIn("-displayfd", xvfb.xvfb_cmd)
+        self.assertEqual(display, xvfb.new_display)
+        self.assertTrue(xvfb.is_alive())
+
+    def test_stop_is_not_reported_as_crash(self):
+        crashes = []
+        with Xvfb(restart_on_crash=True, crash_callback=lambda *a: crashes.append(a)):
+            pass
+        self.assertEqual([], crashes)
+
+    def test_stop_all_is_not_reported_as_crash(self):
+        crashes = []
+        restarted = Xvfb(
+            use_displayfd=True,
+            restart_on_crash=True,
+            crash_callback=lambda *a: crashes.append(a),
+        )
+        monitored = Xvfb(crash_callback=lambda *a: crashes.append(a))
+        restarted.start()
+        monitored.start()
+        monitor_threads = [restarted._monitor_thread, monitored._monitor_thread]
+        stop_all()
+        for thread in monitor_threads:
+            self.assertFalse(thread.is_alive())
+        self.assertEqual([], crashes)
+        self.assertIsNone(restarted.proc)
+        self.assertIsNone(monitored.proc)
+
         xvfb = Xvfb()
         xvfb2 = Xvfb()
         xvfb3 = Xvfb()
@@ -324,24 +857,182 @@ class TestXvfb(XvfbCleanTestCase):
         self.addCleanup(xvfb2._cleanup_lock_file)
         self.addCleanup(xvfb3._cleanup_lock_file)
         side_effect = [11, 11, 22, 11, 22, 11, 22, 22, 22, 33]
-        with patch("xvfbwrapper.randint", side_effect=side_effect) as mockrandint:
+        with (
+            patch("xvfbwrapper.randint", side_effect=side_effect) as mockrandint,
+            warnings.catch_warnings(record=True) as caught,
+        ):
+            warnings.simplefilter("always", ResourceWarning)
             self.assertEqual(xvfb._get_next_unused_display(), 11)
             self.assertEqual(mockrandint.call_count, 1)
-            if sys.implementation.name == "cpython":
-                # ResourceWarning is only raised on CPython because
-                # of an implementation detail in it's garbage collector.
-                # This does not occur on other Python implementations
-                # (like PyPy).
-                with self.assertWarns(ResourceWarning):
-                    self.assertEqual(xvfb2._get_next_unused_display(), 22)
-                    self.assertEqual(mockrandint.call_count, 3)
-                    self.assertEqual(xvfb3._get_next_unused_display(), 33)
-                    self.assertEqual(mockrandint.call_count, 10)
-            else:
-                self.assertEqual(xvfb2._get_next_unused_display(), 22)
-                self.assertEqual(mockrandint.call_count, 3)
-                self.assertEqual(xvfb3._get_next_unused_display(), 33)
-                self.assertEqual(mockrandint.call_count, 10)
+            self.assertEqual(xvfb2._get_next_unused_display(), 22)
+            self.assertEqual(mockrandint.call_count, 3)
+            self.assertEqual(xvfb3._get_next_unused_display(), 33)
+            self.assertEqual(mockrandint.call_count, 10)
+            gc.collect()
+        # Files of failed lock attempts are closed, not leaked
+        self.assertEqual([], [w for w in caught if w.category is ResourceWarning])
+
+    def test_lock_on_deleted_file_is_retried(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir)
+            self.addCleanup(xvfb._cleanup_lock_file)
+            # The first file is deleted by its previous owner while locking
+            with patch("xvfbwrapper._is_same_file", side_effect=[False, True]):
+                self.assertTrue(xvfb._get_lock_for_display(42))
+            self.assertTrue(Path(tempdir, ".X42-lock").exists())
+            xvfb._cleanup_lock_file()
+            self.assertFalse(Path(tempdir, ".X42-lock").exists())
+            self.assertIsNone(xvfb._lock_display_file)
+
+    def test_cleanup_stale(self):
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+        dead_pid = proc.pid
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir)
+            self.addCleanup(xvfb._cleanup_lock_file)
+            self.assertTrue(xvfb._get_lock_for_display(90001))
+            paths = [Path(tempdir, f".X{n}-lock") for n in range(90001, 90005)]
+            paths[1].touch()
+            paths[2].write_text(f"{os.getpid():10d}\n")
+            paths[3].write_text(f"{dead_pid:10d}\n")
+            Path(tempdir, ".Xfoo-lock").touch()
+            self.assertEqual([paths[1], paths[3]], cleanup_stale(tempdir))
+            self.assertEqual(
+                [True, False, True, False], [path.exists() for path in paths]
+            )
+            self.assertTrue(Path(tempdir, ".Xfoo-lock").exists())
+
+    def test_cleanup_stale_with_socket_dir(self):
+        with (
+            tempfile.TemporaryDirectory() as tempdir,
+            tempfile.TemporaryDirectory() as socket_dir,
+        ):
+            path = Path(tempdir, ".X90010-lock")
+            path.touch()
+            Path(socket_dir, "X90010").touch()
+            self.assertEqual([], cleanup_stale(tempdir, socket_dir=socket_dir))
+            self.assertEqual([path], cleanup_stale(tempdir))
+
+    @unittest.skipUnless(sys.platform == "linux", "requires abstract sockets")
+    def test_start_with_socket_dir(self):
+        # Like a container with a private /tmp: the socket file is not
+        # visible, but the abstract socket is
+        with tempfile.TemporaryDirectory() as socket_dir:
+            xvfb = Xvfb(socket_dir=socket_dir)
+            self.addCleanup(xvfb.stop)
+            xvfb.start()
+            self.assertEqual(
+                Path(socket_dir, f"X{xvfb.new_display}"),
+                xvfb._display_socket(xvfb.new_display),
+            )
+            self.assertTrue(xvfb.is_alive())
+            self.assertTrue(xvfb._local_display_exists(xvfb.new_display))
+            xvfb.reset()
+            xvfb.stop()
+            self.assertFalse(xvfb._local_display_exists(xvfb.new_display))
+
+    def test_display_ready_when_accepting_connections(self):
+        with tempfile.TemporaryDirectory() as socket_dir:
+            xvfb = Xvfb(socket_dir=socket_dir)
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.bind(str(Path(socket_dir, "X90011")))
+                # The socket file exists before the server listens
+                self.assertTrue(xvfb._local_display_exists(90011))
+                self.assertFalse(xvfb._display_accepts_connections(90011))
+                sock.listen()
+                self.assertTrue(xvfb._display_accepts_connections(90011))
+
+    def test_get_next_unused_display_skips_running_servers(self):
+        xvfb = Xvfb()
+        self.addCleanup(xvfb._cleanup_lock_file)
+        with (
+            patch("xvfbwrapper.randint", side_effect=[11, 22]),
+            patch.object(xvfb, "_local_display_exists", side_effect=[True, False]),
+        ):
+            self.assertEqual(xvfb._get_next_unused_display(), 22)
+
+    def test_display_range_allocates_in_order(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfbs = [
+                Xvfb(tempdir=tempdir, display_range=range(50, 60)) for _ in range(3)
+            ]
+            for xvfb in xvfbs:
+                self.addCleanup(xvfb._cleanup_lock_file)
+            displays = [xvfb._get_next_unused_display() for xvfb in xvfbs]
+            self.assertEqual([50, 51, 52], displays)
+
+    def test_display_range_skips_used_displays(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir, display_range=range(50, 60))
+            xvfb2 = Xvfb(tempdir=tempdir, display_range=range(50, 60))
+            self.addCleanup(xvfb._cleanup_lock_file)
+            self.addCleanup(xvfb2._cleanup_lock_file)
+            with patch.object(
+                xvfb, "_local_display_exists", side_effect=lambda d: d == 50
+            ):
+                self.assertEqual(51, xvfb._get_next_unused_display())
+            # the cursor wraps around and skips the display locked by xvfb
+            with patch.object(xvfb2, "_local_display_exists", return_value=False):
+                for _ in range(9):
+                    xvfb2._cleanup_lock_file()
+                    self.assertNotEqual(51, xvfb2._get_next_unused_display())
+
+    def test_display_range_closes_failed_lock_files(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir, display_range=range(50, 60))
+            xvfb2 = Xvfb(tempdir=tempdir, display_range=range(50, 60))
+            self.addCleanup(xvfb._cleanup_lock_file)
+            self.addCleanup(xvfb2._cleanup_lock_file)
+            self.assertEqual(50, xvfb._get_next_unused_display())
+            Path(tempdir, ".xvfbwrapper-display-index-50-60").write_text("50")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always", ResourceWarning)
+                self.assertEqual(51, xvfb2._get_next_unused_display())
+                gc.collect()
+            self.assertEqual([], [w for w in caught if w.category is ResourceWarning])
+
+    def test_display_ranges_have_separate_cursors(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfbs = [
+                Xvfb(tempdir=tempdir, display_range=display_range)
+                for display_range in (range(50, 60), range(70, 80), range(50, 60))
+            ]
+            for xvfb in xvfbs:
+                self.addCleanup(xvfb._cleanup_lock_file)
+            displays = [xvfb._get_next_unused_display() for xvfb in xvfbs]
+            self.assertEqual([50, 70, 51], displays)
+
+    def test_display_range_exhausted(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir, display_range=range(50, 52))
+            with (
+                patch.object(xvfb, "_local_display_exists", return_value=True),
+                self.assertRaisesRegex(RuntimeError, "No free display available"),
+            ):
+                xvfb._get_next_unused_display()
+
+    def test_invalid_display_range(self):
+        with self.assertRaisesRegex(ValueError, "Invalid display range"):
+            Xvfb(display_range=range(0))
+
+    def test_start_with_display_range_and_displayfd(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(
+                tempdir=tempdir, display_range=range(100, 200), use_displayfd=True
+            )
+            self.addCleanup(xvfb.stop)
+            xvfb.start()
+            self.assertIn(xvfb.new_display, range(100, 200))
+            self.assertIn(f":{xvfb.new_display}", xvfb.xvfb_cmd)
+
+    def test_start_with_display_range(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            xvfb = Xvfb(tempdir=tempdir, display_range=range(100, 200))
+            self.addCleanup(xvfb.stop)
+            xvfb.start()
+            self.assertIn(xvfb.new_display, range(100, 200))
+            self.assertEqual(f":{xvfb.new_display}", os.environ["DISPLAY"])
 
     def test_environ_keyword_isolates_environment_modification(self):
         # Check that start and stop methods modified the environ dict if
@@ -370,6 +1061,304 @@ class TestXvfb(XvfbCleanTestCase):
             marker_value,
         )
 
+    def test_isolate_environ_does_not_modify_os_environ(self):
+        xvfb = Xvfb(isolate_environ=True, set_xdg_session_type=True)
+        self.assertIsNot(os.environ, xvfb.environ)
+        with patch.dict("os.environ", {"XDG_SESSION_TYPE": "wayland"}):
+            xvfb = Xvfb(isolate_environ=True, set_xdg_session_type=True)
+            self.assertEqual("wayland", os.environ["XDG_SESSION_TYPE"])
+            self.assertEqual("x11", xvfb.environ["XDG_SESSION_TYPE"])
+            xvfb.start()
+            self.assertEqual(":0", os.environ["DISPLAY"])
+            self.assertEqual(f":{xvfb.new_display}", xvfb.environ["DISPLAY"])
+            xvfb.stop()
+            self.assertEqual(":0", os.environ["DISPLAY"])
+            self.assertEqual(":0", xvfb.environ["DISPLAY"])
+
+    def test_isolate_environ_copies_environ_keyword(self):
+        custom_env = {"PATH": os.environ.get("PATH", "")}
+        xvfb = Xvfb(environ=custom_env, isolate_environ=True)
+        self.addCleanup(xvfb.stop)
+        xvfb.start()
+        self.assertNotIn("DISPLAY", custom_env)
+        self.assertEqual(f":{xvfb.new_display}", xvfb.environ["DISPLAY"])
+
+    def test_display_name(self):
+        xvfb = Xvfb()
+        self.assertIsNone(xvfb.display_name)
+        with xvfb:
+            self.assertEqual(f":{xvfb.new_display}", xvfb.display_name)
+        self.assertIsNone(xvfb.display_name)
+
+    def test_env_and_run_in_display(self):
+        with Xvfb(isolate_environ=True) as xvfb:
+            env = xvfb.env()
+            self.assertEqual(xvfb.display_name, env["DISPLAY"])
+            env["DISPLAY"] = "changed"
+            self.assertEqual(xvfb.display_name, xvfb.environ["DISPLAY"])
+            cmd = [sys.executable, "-c", "import os; print(os.environ['DISPLAY'])"]
+            result = xvfb.run(cmd, capture_output=True, text=True)
+            self.assertEqual(xvfb.display_name, result.stdout.strip())
+            proc = xvfb.popen(cmd, stdout=-1, text=True)
+            self.assertEqual(xvfb.display_name, proc.communicate()[0].strip())
+
+    def test_memory_usage(self):
+        xvfb = Xvfb(disable_extensions=["GLX"], max_clients=64, shmem=True)
+        self.assertRaisesRegex(RuntimeError, "not running", xvfb.memory_usage)
+        with xvfb:
+            usage = xvfb.memory_usage()
+        self.assertGreater(usage.rss, 0)
+        self.assertGreaterEqual(usage.peak_rss, usage.rss)
+        self.assertEqual(usage.rss, usage.anon + usage.file + usage.shmem)
+
+    def test_framebuffer(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, fbdir=fbdir) as xvfb,
+        ):
+            self.assertTrue(self.contains_sublist(xvfb.xvfb_cmd, ["-fbdir", fbdir]))
+            framebuffer = xvfb.framebuffer()
+            self.assertEqual(
+                (320, 240, 24),
+                (framebuffer.width, framebuffer.height, framebuffer.depth),
+            )
+            self.assertEqual((240, 320, 4), framebuffer.pixels.shape)
+            self.assertTrue(framebuffer.pixels.readonly)
+
+    def test_screenshot(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, fbdir=fbdir) as xvfb,
+        ):
+            path = Path(fbdir, "screenshot.png")
+            png = xvfb.screenshot(path)
+            self.assertEqual(png, path.read_bytes())
+        self.assertTrue(png.startswith(b"\x89PNG\r\n\x1a\n"))
+        # The IHDR chunk holds the width and height of the image
+        self.assertEqual(b"IHDR", png[12:16])
+        self.assertEqual((320).to_bytes(4, "big"), png[16:20])
+        self.assertEqual((240).to_bytes(4, "big"), png[20:24])
+
+    def test_stream_frames(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, fbdir=fbdir) as xvfb,
+        ):
+            frames = xvfb.stream_frames(fps=100)
+            first = next(frames)
+            self.assertEqual(
+                (0, 0, 320, 240), (first.x, first.y, first.width, first.height)
+            )
+            self.assertEqual(320 * 240 * 3, len(first.rgb))
+            # A blue rectangle, in BGRX pixel format
+            draw_rectangle(fbdir, 100, 50, 10, 5, b"\xff\x00\x00\x00")
+            frame = next(frames)
+            self.assertGreater(frame.timestamp, first.timestamp)
+            self.assertEqual((50, 5), (frame.y, frame.height))
+            self.assertLessEqual(frame.x, 100)
+            self.assertGreaterEqual(frame.x + frame.width, 110)
+            self.assertLess(frame.width, 320)
+            offset = ((55 - 1 - frame.y) * frame.width + 109 - frame.x) * 3
+            self.assertEqual(b"\x00\x00\xff", frame.rgb[offset : offset + 3])
+        with self.assertRaisesRegex(ValueError, "must be positive"):
+            xvfb.stream_frames(fps=0)
+
+    def wait_for_frames(self, recorder, count):
+        deadline = time.monotonic() + 5
+        while recorder.frame_count < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(count, recorder.frame_count)
+
+    def test_record(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, fbdir=fbdir) as xvfb,
+        ):
+            with xvfb.record(fps=100) as recorder:
+                self.wait_for_frames(recorder, 1)
+                time.sleep(0.05)
+                # Unchanged screens are not recorded
+                self.assertEqual(1, recorder.frame_count)
+                draw_rectangle(fbdir, 0, 200, 320, 10, b"\xff\xff\xff\x00")
+                self.wait_for_frames(recorder, 2)
+            path = Path(fbdir, "recording.png")
+            recorder.save(path)
+            chunks = png_chunks(path.read_bytes())
+        self.assertEqual(
+            [b"IHDR", b"acTL", b"fcTL", b"IDAT", b"fcTL", b"fdAT", b"IEND"],
+            [chunk_type for chunk_type, _ in chunks],
+        )
+        self.assertEqual((2, 0), struct.unpack(">II", chunks[1][1]))
+        # Sequence number, size and offset of the frame with the change
+        self.assertEqual((1, 320, 10, 0, 200), struct.unpack(">5I", chunks[4][1][:20]))
+        self.assertEqual(2, struct.unpack(">I", chunks[5][1][:4])[0])
+        recorder.clear()
+        self.assertEqual(0, recorder.frame_count)
+        with self.assertRaisesRegex(RuntimeError, "Nothing was recorded"):
+            recorder.to_apng()
+
+    def test_record_merges_frames_over_max_bytes(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, fbdir=fbdir) as xvfb,
+            xvfb.record(fps=100, max_bytes=320 * 3 * 2) as recorder,
+        ):
+            self.wait_for_frames(recorder, 1)
+            for y in range(3):
+                draw_rectangle(fbdir, 0, y, 320, 1, b"\xff\xff\xff\x00")
+                time.sleep(0.05)
+            self.wait_for_frames(recorder, 3)
+        chunks = png_chunks(recorder.to_apng())
+        self.assertEqual((3, 0), struct.unpack(">II", chunks[1][1]))
+        # The oldest change was merged into the first frame
+        scanlines = zlib.decompress(chunks[3][1])
+        stride = 1 + 320 * 3
+        self.assertEqual(b"\xff" * 320 * 3, scanlines[1:stride])
+        self.assertNotEqual(b"\xff" * 320 * 3, scanlines[stride + 1 : stride * 2])
+
+    def test_framebuffer_requires_fbdir(self):
+        xvfb = Xvfb()
+        with self.assertRaisesRegex(RuntimeError, "Xvfb is not running"):
+            xvfb.framebuffer()
+        with xvfb, self.assertRaisesRegex(RuntimeError, "not started with fbdir"):
+            xvfb.screenshot()
+
+    def test_framebuffer_of_screen(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(width=320, height=240, screens=2, fbdir=fbdir) as xvfb,
+        ):
+            self.assertEqual(240, xvfb.framebuffer(screen=1).height)
+            with self.assertRaisesRegex(ValueError, "Invalid screen: 2"):
+                xvfb.framebuffer(screen=2)
+
+    def test_acquire_screen(self):
+        xvfb = Xvfb(screens=2)
+        with self.assertRaisesRegex(RuntimeError, "Xvfb is not running"):
+            xvfb.acquire_screen()
+        with xvfb:
+            display = xvfb.display_name
+            self.assertEqual(f"{display}.0", xvfb.acquire_screen())
+            self.assertEqual(f"{display}.1", xvfb.acquire_screen())
+            with self.assertRaisesRegex(RuntimeError, "No free screen"):
+                xvfb.acquire_screen()
+            xvfb.release_screen(f"{display}.0")
+            self.assertEqual(f"{display}.0", xvfb.acquire_screen())
+        with xvfb:
+            self.assertEqual(f"{xvfb.display_name}.0", xvfb.acquire_screen())
+
+    def test_release_screen_not_in_use(self):
+        with Xvfb(screens=2) as xvfb:
+            for display_name in (f"{xvfb.display_name}.1", ":999999.0", "bogus"):
+                with self.assertRaisesRegex(ValueError, "Screen is not in use"):
+                    xvfb.release_screen(display_name)
+
+    def assert_display_is_reset(self, xvfb, client, atom):
+        with self.assertRaises((OSError, RuntimeError)):
+            client.sync()
+        client._socket.close()
+        with _XConnection(xvfb._display_socket(xvfb.new_display), 5) as connection:
+            self.assertNotIn(atom, connection.list_properties(connection.roots[0]))
+            for selection in (1, connection.intern_atom("CLIPBOARD")):
+                # GetSelectionOwner
+                data = struct.pack("<I", selection)
+                reply = connection.reply(connection.send(23, data))
+                self.assertEqual(0, struct.unpack_from("<I", reply, 8)[0])
+
+    def test_reset(self):
+        with Xvfb() as xvfb:
+            client, atom = connect_x_client(xvfb)
+            proc, display = xvfb.proc, xvfb.new_display
+            xvfb.reset()
+            self.assertIs(proc, xvfb.proc)
+            self.assertEqual(display, xvfb.new_display)
+            self.assertTrue(xvfb.is_alive())
+            self.assert_display_is_reset(xvfb, client, atom)
+
+    def test_reset_without_x_resource_extension(self):
+        with Xvfb(extra_args=["-extension", "X-Resource"]) as xvfb:
+            client, atom = connect_x_client(xvfb)
+            xvfb.reset()
+            self.assert_display_is_reset(xvfb, client, atom)
+
+    def test_reset_when_not_running(self):
+        with self.assertRaisesRegex(RuntimeError, "Xvfb is not running"):
+            Xvfb().reset()
+
+    def test_resize(self):
+        with (
+            tempfile.TemporaryDirectory() as fbdir,
+            Xvfb(320, 240, max_width=640, max_height=480, fbdir=fbdir) as xvfb,
+        ):
+            self.assertIn("640x480x24", xvfb.xvfb_cmd)
+            # Started at the maximum size, and shrunk before start() returned
+            self.assertEqual((320, 240), screen_size(xvfb))
+            framebuffer = xvfb.framebuffer()
+            self.assertEqual((320, 240), (framebuffer.width, framebuffer.height))
+            self.assertEqual(640 * 4, framebuffer.bytes_per_line)
+            self.assertTrue(xvfb.screenshot().startswith(b"\x89PNG"))
+            xvfb.resize(640, 480)
+            self.assertEqual((640, 480), screen_size(xvfb))
+            self.assertEqual(640, xvfb.framebuffer().width)
+            xvfb.resize(100, 50)
+            self.assertEqual((100, 50), screen_size(xvfb))
+            with self.assertRaisesRegex(ValueError, "outside the supported range"):
+                xvfb.resize(800, 600)
+            with self.assertRaisesRegex(ValueError, "Invalid screen: 1"):
+                xvfb.resize(100, 50, screen=1)
+
+    def test_resize_screen(self):
+        with Xvfb(320, 240, screens=2) as xvfb:
+            xvfb.resize(200, 100, screen=1)
+            self.assertEqual((320, 240), screen_size(xvfb, 0))
+            self.assertEqual((200, 100), screen_size(xvfb, 1))
+
+    def test_resize_without_randr(self):
+        with (
+            Xvfb(disable_extensions=["RANDR"]) as xvfb,
+            self.assertRaisesRegex(RuntimeError, "does not support the RANDR"),
+        ):
+            xvfb.resize(640, 480)
+        with self.assertRaisesRegex(RuntimeError, "does not support the RANDR"):
+            Xvfb(max_width=1024, disable_extensions=["RANDR"]).start()
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    def test_resize_when_not_running(self):
+        with self.assertRaisesRegex(RuntimeError, "Xvfb is not running"):
+            Xvfb().resize(640, 480)
+
+    def test_invalid_max_size(self):
+        with self.assertRaisesRegex(ValueError, "640x480 is smaller than 800x680"):
+            Xvfb(max_width=640, max_height=480)
+
+    def test_screen_context_manager(self):
+        with Xvfb(screens=2) as xvfb:
+            with xvfb.screen() as first, xvfb.screen() as second:
+                self.assertEqual(f"{xvfb.display_name}.0", first)
+                self.assertEqual(f"{xvfb.display_name}.1", second)
+                result = xvfb.run(
+                    [sys.executable, "-c", "import os; print(os.environ['DISPLAY'])"],
+                    env=dict(xvfb.env(), DISPLAY=second),
+                    capture_output=True,
+                    text=True,
+                )
+                self.assertEqual(second, result.stdout.strip())
+            self.assertEqual(f"{xvfb.display_name}.0", xvfb.acquire_screen())
+
+    def test_isolate_environ_in_threads(self):
+        xvfbs = [Xvfb(isolate_environ=True) for _ in range(4)]
+        threads = [threading.Thread(target=xvfb.start) for xvfb in xvfbs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        try:
+            self.assertEqual(":0", os.environ["DISPLAY"])
+            self.assertEqual(4, len({xvfb.display_name for xvfb in xvfbs}))
+        finally:
+            for xvfb in xvfbs:
+                xvfb.stop()
+
     def test_start_failure_without_initial_display_env(self):
         # Provide a custom env *without* DISPLAY so orig_display_var == None
         custom_env = {"PATH": os.environ.get("PATH", "")}
@@ -385,9 +1374,9 @@ class TestXvfb(XvfbCleanTestCase):
             "-foo",
             "bar",
         ]
-        # Force the display socket to never appear
+        # Force the display to never accept connections
         with (
-            patch.object(xvfb, "_local_display_exists", return_value=False),
+            patch.object(xvfb, "_display_accepts_connections", return_value=False),
             self.assertRaisesRegex(
                 RuntimeError,
                 f"Xvfb display did not open: {expected_cmd_args}",
@@ -401,5 +1390,514 @@ class TestXvfb(XvfbCleanTestCase):
         self.assertIsNone(xvfb.proc)
 
 
+@patch.dict("os.environ", {"XDG_SESSION_TYPE": "x11", "DISPLAY": ":0"})
+class TestAsyncXvfb(XvfbCleanTestCase, unittest.IsolatedAsyncioTestCase):
+    async def test_start_and_stop_as_context_manager(self):
+        async with AsyncXvfb() as xvfb:
+            self.assertIsNotNone(xvfb.proc)
+            self.assertIn("-displayfd", xvfb.xvfb.xvfb_cmd)
+            self.assertEqual(f":{xvfb.new_display}", os.environ["DISPLAY"])
+        self.assertEqual(":0", os.environ["DISPLAY"])
+        self.assertIsNone(xvfb.proc)
+
+    async def test_screenshot(self):
+        with tempfile.TemporaryDirectory() as fbdir:
+            async with AsyncXvfb(width=320, height=240, fbdir=fbdir) as xvfb:
+                self.assertEqual(320, xvfb.framebuffer().width)
+                png = xvfb.screenshot()
+        self.assertTrue(png.startswith(b"\x89PNG\r\n\x1a\n"))
+
+    async def test_memory_usage(self):
+        async with AsyncXvfb(max_clients=128) as xvfb:
+            self.assertGreater(xvfb.memory_usage().rss, 0)
+
+    async def test_reset(self):
+        async with AsyncXvfb() as xvfb:
+            client, _ = connect_x_client(xvfb.xvfb)
+            self.addCleanup(client._socket.close)
+            await xvfb.reset()
+            with self.assertRaises((OSError, RuntimeError)):
+                client.sync()
+
+    async def test_resize(self):
+        async with AsyncXvfb(320, 240, max_width=640, max_height=480) as xvfb:
+            self.assertEqual((320, 240), screen_size(xvfb.xvfb))
+            await xvfb.resize(640, 480)
+            self.assertEqual((640, 480), screen_size(xvfb.xvfb))
+
+    async def test_start_with_display_range(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            async with AsyncXvfb(
+                tempdir=tempdir, display_range=range(100, 110)
+            ) as xvfb:
+                self.assertIn(xvfb.new_display, range(100, 110))
+
+    async def test_start_with_specific_display(self):
+        async with AsyncXvfb(display=42) as xvfb:
+            self.assertEqual(42, xvfb.new_display)
+
+    async def test_timings_and_metrics_callback(self):
+        events = []
+        async with AsyncXvfb(
+            metrics_callback=lambda event, _: events.append(event)
+        ) as xvfb:
+            self.assertGreater(xvfb.timings.spawn_ms, 0)
+            self.assertGreater(xvfb.timings.ready_ms, 0)
+        self.assertGreater(xvfb.timings.shutdown_ms, 0)
+        self.assertEqual(["start", "stop"], events)
+
+    async def test_start_many_concurrently(self):
+        xvfbs = [AsyncXvfb(environ=os.environ.copy()) for _ in range(5)]
+        await asyncio.gather(*(xvfb.start() for xvfb in xvfbs))
+        try:
+            self.assertEqual(5, len({xvfb.new_display for xvfb in xvfbs}))
+            for xvfb in xvfbs:
+                self.assertEqual(f":{xvfb.new_display}", xvfb.environ["DISPLAY"])
+        finally:
+            await asyncio.gather(*(xvfb.stop() for xvfb in xvfbs))
+        self.assertTrue(all(xvfb.proc is None for xvfb in xvfbs))
+
+    async def test_start_fails_with_unknown_kwargs(self):
+        xvfb = AsyncXvfb(foo="bar")
+        with self.assertRaisesRegex(XvfbError, "Xvfb did not start") as cm:
+            await xvfb.start()
+        self.assertIn("Unrecognized option: -foo", cm.exception.output)
+        self.assertEqual(cm.exception.output, xvfb.output())
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    async def test_crash_monitoring_not_supported(self):
+        with self.assertRaisesRegex(ValueError, "does not support crash monitoring"):
+            AsyncXvfb(restart_on_crash=True)
+
+    async def test_start_timeout(self):
+        xvfb = AsyncXvfb(timeout=0.5)
+        with (
+            patch.object(xvfb, "_wait_for_displayfd", return_value=None),
+            self.assertRaisesRegex(RuntimeError, "Xvfb display did not open"),
+        ):
+            await xvfb.start()
+        self.assertIsNone(xvfb.proc)
+
+    async def test_stop_kills_after_grace_period(self):
+        xvfb = AsyncXvfb(grace_period=0.2)
+        await xvfb.start()
+        xvfb.proc.terminate()
+        await xvfb.proc.wait()
+        code = (
+            "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+            "print(flush=True); time.sleep(60)"
+        )
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", code, stdout=subprocess.PIPE
+        )
+        await proc.stdout.readline()
+        xvfb.proc = proc
+        start = time.monotonic()
+        await asyncio.wait_for(xvfb.stop(), 10)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(-signal.SIGKILL, proc.returncode)
+        self.assertIsNone(xvfb.proc)
+
+    async def test_start_cancelled(self):
+        xvfb = AsyncXvfb(display=42)
+
+        async def never_ready(read_fd):
+            self.addCleanup(os.close, read_fd)
+            await asyncio.Event().wait()
+
+        with (
+            patch.object(xvfb, "_wait_for_displayfd", side_effect=never_ready),
+            self.assertRaises(asyncio.TimeoutError),
+        ):
+            await asyncio.wait_for(xvfb.start(), 0.5)
+        self.assertIsNone(xvfb.proc)
+        async with AsyncXvfb(display=42) as xvfb2:
+            self.assertEqual(42, xvfb2.new_display)
+
+    async def test_stop_if_not_running_doesnt_raise_error(self):
+        xvfb = AsyncXvfb()
+        await xvfb.stop()
+        self.assertIsNone(xvfb.proc)
+
+
+@patch.dict("os.environ", {"XDG_SESSION_TYPE": "x11", "DISPLAY": ":0"})
+class TestXvfbPool(XvfbCleanTestCase):
+    def test_acquire_and_release(self):
+        with XvfbPool(size=2) as pool:
+            xvfb = pool.acquire(timeout=10)
+            self.assertIsNotNone(xvfb.proc)
+            self.assertEqual(f":{xvfb.new_display}", xvfb.environ["DISPLAY"])
+            self.assertEqual(":0", os.environ["DISPLAY"])
+            pool.release(xvfb)
+            self.assertRaises(ValueError, pool.release, xvfb)
+
+    def test_acquired_displays_are_unique(self):
+        with XvfbPool(size=3) as pool:
+            xvfbs = [pool.acquire(timeout=10) for _ in range(3)]
+            self.assertEqual(3, len({xvfb.new_display for xvfb in xvfbs}))
+            for xvfb in xvfbs:
+                pool.release(xvfb)
+
+    def test_release_refills_pool(self):
+        with XvfbPool(size=1) as pool:
+            xvfb = pool.acquire(timeout=10)
+            pool.release(xvfb)
+            xvfb2 = pool.acquire(timeout=10)
+            self.assertIsNot(xvfb, xvfb2)
+            self.assertIsNone(xvfb.proc)
+            self.assertIsNotNone(xvfb2.proc)
+
+    def test_display_context_manager(self):
+        with XvfbPool(size=1) as pool:
+            with pool.display(timeout=10) as xvfb:
+                self.assertIsNotNone(xvfb.proc)
+            with pool.display(timeout=10) as xvfb2:
+                self.assertIsNotNone(xvfb2.proc)
+
+    def test_close_stops_servers_in_use(self):
+        pool = XvfbPool(size=1)
+        pool.start()
+        xvfb = pool.acquire(timeout=10)
+        pool.close()
+        self.assertIsNone(xvfb.proc)
+
+    def test_acquire_raises_start_errors(self):
+        with (
+            XvfbPool(size=1, use_displayfd=True, foo="bar") as pool,
+            self.assertRaisesRegex(RuntimeError, "Xvfb did not start"),
+        ):
+            pool.acquire(timeout=10)
+
+    def test_acquire_when_not_started(self):
+        pool = XvfbPool()
+        with self.assertRaisesRegex(RuntimeError, "XvfbPool is not started"):
+            pool.acquire()
+
+    def test_reset_on_release(self):
+        with XvfbPool(size=1, reset_on_release=True) as pool:
+            xvfb = pool.acquire(timeout=10)
+            proc = xvfb.proc
+            client, _ = connect_x_client(xvfb)
+            self.addCleanup(client._socket.close)
+            pool.release(xvfb)
+            self.assertIs(xvfb, pool.acquire(timeout=10))
+            self.assertIs(proc, xvfb.proc)
+            with self.assertRaises((OSError, RuntimeError)):
+                client.sync()
+
+    def test_reset_on_release_replaces_broken_servers(self):
+        with XvfbPool(size=1, reset_on_release=True) as pool:
+            xvfb = pool.acquire(timeout=10)
+            with patch.object(xvfb, "reset", side_effect=RuntimeError("broken")):
+                pool.release(xvfb)
+                self.assertIsNot(xvfb, pool.acquire(timeout=10))
+            self.assertIsNone(xvfb.proc)
+
+    def test_stop_all_leaves_pooled_servers(self):
+        with XvfbPool(size=1) as pool:
+            stop_all()
+            xvfb = pool.acquire(timeout=10)
+            self.assertIsNotNone(xvfb.proc)
+            self.assertIsNone(xvfb.proc.poll())
+
+    def test_isolate_environ_argument(self):
+        with XvfbPool(size=1, isolate_environ=True) as pool:
+            self.assertIsNotNone(pool.acquire(timeout=10).proc)
+        with self.assertRaisesRegex(ValueError, "always use isolate_environ"):
+            XvfbPool(isolate_environ=False)
+
+    def test_invalid_xvfb_arguments(self):
+        with self.assertRaisesRegex(ValueError, "Invalid display range"):
+            XvfbPool(display_range=range(0))
+
+    def test_acquire_raises_unexpected_errors(self):
+        with XvfbPool(size=1) as pool:
+            xvfb = pool.acquire(timeout=10)
+            with (
+                patch.object(Xvfb, "start", side_effect=ValueError("boom")),
+                self.assertRaisesRegex(ValueError, "boom"),
+            ):
+                pool.release(xvfb)
+                pool.acquire(timeout=10)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            XvfbPool(size=0)
+
+
+class TestXvfbDaemon(XvfbCleanTestCase):
+    def tearDown(self):
+        # Close daemons before their servers are killed by the base class
+        self.doCleanups()
+        super().tearDown()
+
+    def start_daemon(self, **kwargs):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        socket_path = Path(tempdir.name, "xvfb.sock")
+        xvfb_daemon = XvfbDaemon(socket_path, **kwargs)
+        xvfb_daemon.start()
+        self.addCleanup(xvfb_daemon.close)
+        return xvfb_daemon
+
+    @staticmethod
+    def send(sock, **request):
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        return json.loads(sock.makefile("rb").readline())
+
+    def wait_for_no_leases(self, xvfb_daemon):
+        deadline = time.monotonic() + 5
+        while xvfb_daemon._leases and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({}, xvfb_daemon._leases)
+
+    def test_lease_and_release(self):
+        xvfb_daemon = self.start_daemon(size=1)
+        with XvfbLease(xvfb_daemon.socket_path) as lease:
+            self.assertRegex(lease.display_name, r"^:\d+$")
+            self.assertEqual(lease.display_name, lease.env()["DISPLAY"])
+            self.assertEqual(60, lease.ttl)
+            display_name = lease.display_name
+        self.wait_for_no_leases(xvfb_daemon)
+        self.assertIsNone(lease.display_name)
+        # The released display was replaced by a fresh server
+        with XvfbLease(xvfb_daemon.socket_path, timeout=10) as lease:
+            self.assertNotEqual(display_name, lease.display_name)
+
+    def test_leased_displays_are_unique(self):
+        xvfb_daemon = self.start_daemon(size=2)
+        with (
+            XvfbLease(xvfb_daemon.socket_path) as first,
+            XvfbLease(xvfb_daemon.socket_path) as second,
+        ):
+            self.assertNotEqual(first.display_name, second.display_name)
+
+    def test_lease_ends_when_client_disconnects(self):
+        xvfb_daemon = self.start_daemon(size=1)
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(str(xvfb_daemon.socket_path))
+            self.assertIn("display", self.send(sock, op="lease"))
+            self.assertEqual(1, len(xvfb_daemon._leases))
+        self.wait_for_no_leases(xvfb_daemon)
+
+    def test_lease_expires(self):
+        xvfb_daemon = self.start_daemon(size=1, ttl=0.2)
+        with XvfbLease(xvfb_daemon.socket_path) as lease:
+            self.wait_for_no_leases(xvfb_daemon)
+            with self.assertRaisesRegex(RuntimeError, "Lease is not active"):
+                lease.renew()
+
+    def test_renew(self):
+        xvfb_daemon = self.start_daemon(size=1)
+        with XvfbLease(xvfb_daemon.socket_path, ttl=0.3) as lease:
+            for _ in range(5):
+                time.sleep(0.1)
+                lease.renew()
+            self.assertEqual([lease.lease_id], list(xvfb_daemon._leases))
+
+    def test_leases_of_other_clients_are_protected(self):
+        xvfb_daemon = self.start_daemon(size=1)
+        with (
+            XvfbLease(xvfb_daemon.socket_path) as lease,
+            socket.socket(socket.AF_UNIX) as sock,
+        ):
+            sock.connect(str(xvfb_daemon.socket_path))
+            response = self.send(sock, op="release", lease=lease.lease_id)
+            self.assertIn("Lease is not active", response["error"])
+            response = self.send(sock, op="bogus")
+            self.assertIn("Unknown operation", response["error"])
+            self.assertEqual([lease.lease_id], list(xvfb_daemon._leases))
+
+    def test_stale_socket_is_replaced(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            socket_path = Path(tempdir, "xvfb.sock")
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.bind(str(socket_path))
+            with XvfbDaemon(socket_path, size=1), XvfbLease(socket_path) as lease:
+                self.assertIsNotNone(lease.display_name)
+            self.assertFalse(socket_path.exists())
+
+    def test_socket_path_is_not_a_socket(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir, "notes.txt")
+            path.write_text("keep me")
+            with self.assertRaisesRegex(FileExistsError, "Not a socket"):
+                XvfbDaemon(path, size=1).start()
+            self.assertEqual("keep me", path.read_text())
+
+    def test_invalid_ttl(self):
+        with self.assertRaises(ValueError):
+            XvfbDaemon("xvfb.sock", ttl=0)
+
+    def test_run_command_in_leased_display(self):
+        xvfb_daemon = self.start_daemon(size=1)
+        code = "import os; assert os.environ['DISPLAY'].startswith(':')"
+        argv = ["--lease", str(xvfb_daemon.socket_path), "--ttl", "0.2"]
+        self.assertEqual(
+            0,
+            main(
+                [
+                    *argv,
+                    "--",
+                    sys.executable,
+                    "-c",
+                    f"{code}; import time; time.sleep(0.5)",
+                ]
+            ),
+        )
+        self.wait_for_no_leases(xvfb_daemon)
+
+    def test_lease_uses_daemon_ttl_by_default(self):
+        xvfb_daemon = self.start_daemon(size=1, ttl=30)
+        with patch("xvfbwrapper._run_leased", return_value=0) as run_leased:
+            main(["--lease", str(xvfb_daemon.socket_path), "--", "true"])
+        lease = run_leased.call_args.args[1]
+        self.assertIsNone(lease.ttl)
+        with lease:
+            self.assertEqual(30, lease.ttl)
+
+    def test_serve_ttl(self):
+        with patch("xvfbwrapper._serve") as serve:
+            main(["--serve", "xvfb.sock"])
+            main(["--serve", "xvfb.sock", "--ttl", "5"])
+        self.assertEqual([60, 5], [c.args[0].ttl for c in serve.call_args_list])
+
+
+@patch.dict("os.environ", {"XDG_SESSION_TYPE": "x11", "DISPLAY": ":0"})
+class TestMain(XvfbCleanTestCase):
+    def python_command(self, code):
+        return ["--", sys.executable, "-c", code]
+
+    def test_run_command_in_display(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir, "display")
+            code = f"import os; open({str(path)!r}, 'w').write(os.environ['DISPLAY'])"
+            self.assertEqual(0, main(["-W", "320", *self.python_command(code)]))
+            self.assertRegex(path.read_text(), r"^:\d+$")
+        self.assertEqual(":0", os.environ["DISPLAY"])
+
+    def test_exit_status(self):
+        self.assertEqual(3, main(self.python_command("raise SystemExit(3)")))
+
+    def test_command_not_found(self):
+        self.assertEqual(127, main(["no-such-command-for-xvfbwrapper"]))
+
+    def test_attach(self):
+        code = "import os; assert os.environ['DISPLAY'] == ':5'"
+        with patch.object(Xvfb, "start") as start:
+            self.assertEqual(0, main(["--attach", ":5", *self.python_command(code)]))
+        start.assert_not_called()
+
+    def test_xvfb_fails_to_start(self):
+        with self.assertRaises(SystemExit) as cm:
+            main(["--server-args=-foo bar", "true"])
+        self.assertEqual(1, cm.exception.code)
+
+    def test_no_command(self):
+        with self.assertRaises(SystemExit) as cm:
+            main([])
+        self.assertEqual(2, cm.exception.code)
+
+    def test_signals_are_forwarded(self):
+        code = "import time; print(flush=True); time.sleep(60)"
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "xvfbwrapper", *self.python_command(code)],
+            stdout=subprocess.PIPE,
+            env=dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join(
+                    [str(Path(__file__).parent), os.environ.get("PYTHONPATH", "")]
+                ),
+            ),
+        )
+        proc.stdout.readline()
+        proc.stdout.close()
+        proc.terminate()
+        self.assertEqual(128 + signal.SIGTERM, proc.wait(10))
+        self.assertEqual(set(), self.get_xvfb_pids() - self.test_baseline_xvfb_pids)
+
+
+class TestPytestPlugin(XvfbCleanTestCase):
+    def run_pytest(self, test_code, *args):
+        with tempfile.TemporaryDirectory() as tempdir:
+            Path(tempdir, "test_plugin.py").write_text(test_code)
+            env = dict(os.environ, PYTEST_DISABLE_PLUGIN_AUTOLOAD="1")
+            env["PYTHONPATH"] = os.pathsep.join(
+                [str(Path(__file__).parent), env.get("PYTHONPATH", "")]
+            )
+            return subprocess.run(
+                [sys.executable, "-m", "pytest", "-p", "pytest_xvfbwrapper", *args],
+                cwd=tempdir,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+
+    def test_fixtures(self):
+        test_code = """
+import os
+
+displays = []
+
+def test_shared(xvfbwrapper_display):
+    assert os.environ["DISPLAY"] == xvfbwrapper_display.display_name
+    displays.append(xvfbwrapper_display.display_name)
+
+def test_shared_again(xvfbwrapper_display, xvfbwrapper_session):
+    assert xvfbwrapper_display is xvfbwrapper_session
+    assert displays == [xvfbwrapper_display.display_name]
+
+def test_function(xvfbwrapper_function):
+    assert xvfbwrapper_function.display_name not in displays
+    assert os.environ["DISPLAY"] == xvfbwrapper_function.display_name
+"""
+        result = self.run_pytest(test_code)
+        self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+        self.assertIn("3 passed", result.stdout)
+        # The shared display is counted once, by the first test using it
+        self.assertRegex(result.stdout, r"xvfbwrapper: 2 displays started, \d+ ms")
+
+    def test_ini_options(self):
+        test_code = """
+def test_geometry(xvfbwrapper_display):
+    xvfb = xvfbwrapper_display
+    assert (xvfb.width, xvfb.height, xvfb.colordepth) == (320, 240, 16)
+    assert "-nocursor" in xvfb.xvfb_cmd
+"""
+        result = self.run_pytest(
+            test_code,
+            "-o",
+            "xvfbwrapper_width=320",
+            "-o",
+            "xvfbwrapper_height=240",
+            "-o",
+            "xvfbwrapper_colordepth=16",
+            "-o",
+            "xvfbwrapper_args=-nocursor",
+        )
+        self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+
+    def test_names_do_not_clash_with_pytest_xvfb(self):
+        # The fixture and ini option names used by pytest-xvfb
+        test_code = """
+import pytest
+
+def pytest_addoption(parser):
+    parser.addini("xvfb_width", "width", default="1024")
+
+@pytest.fixture
+def xvfb():
+    return "pytest-xvfb"
+
+def test_both(xvfb, xvfbwrapper_display):
+    assert xvfb == "pytest-xvfb"
+    assert xvfbwrapper_display.width == 800
+"""
+        # Loaded as a plugin too, so its ini option is registered
+        result = self.run_pytest(test_code, "-p", "test_plugin", "-o", "xvfb_width=320")
+        self.assertEqual(0, result.returncode, result.stdout + result.stderr)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -4,18 +4,37 @@
 
 """Run a headless display inside X virtual framebuffer (Xvfb)."""
 
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import mmap
 import os
 import platform
+import queue
+import selectors
+import shlex
 import shutil
+import signal
+import socket
+import socketserver
+import stat
+import struct
 import subprocess
+import sys
 import tempfile
+import threading
 import time
-from collections.abc import MutableMapping, Sequence
-from contextlib import suppress
+import zlib
+from collections import deque
+from collections.abc import Callable, Iterator, MutableMapping, Sequence
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
 from pathlib import Path
 from random import randint
 from types import TracebackType
-from typing import TextIO
+from typing import IO, Any, TextIO
 
 try:
     import fcntl
@@ -24,10 +43,969 @@ except ImportError as e:
     raise OSError(f"xvfbwrapper is not supported on this platform: {system}") from e
 
 
+class XvfbError(RuntimeError):
+    """Xvfb failed to start.
+
+    ``output`` holds the latest output of the server, which usually
+    explains why. It is also appended to the message.
+    """
+
+    def __init__(self, message: str, output: str = "") -> None:
+        if output:
+            message = f"{message}\n{output.rstrip()}"
+        super().__init__(message)
+        self.output: str = output
+
+
+@dataclass
+class XvfbTimings:
+    """Time spent in each phase of starting and stopping Xvfb.
+
+    Durations are in milliseconds. ``lock_retries`` is the number of
+    display numbers that could not be locked before one was reserved.
+    """
+
+    lock_ms: float = 0.0
+    spawn_ms: float = 0.0
+    ready_ms: float = 0.0
+    shutdown_ms: float = 0.0
+    lock_retries: int = 0
+
+
+def _elapsed_ms(start: float) -> float:
+    return (time.perf_counter() - start) * 1000
+
+
+@dataclass(frozen=True)
+class XvfbMemoryUsage:
+    """Memory used by an Xvfb process, in bytes.
+
+    ``rss`` is the resident set size, and ``peak_rss`` is its high water
+    mark. It is split into ``anon`` (heap), ``file`` (mapped files, which
+    include framebuffers created with ``fbdir``) and ``shmem`` (shared
+    memory, which includes framebuffers created with ``shmem``).
+    """
+
+    rss: int
+    peak_rss: int
+    anon: int
+    file: int
+    shmem: int
+
+
+@dataclass(frozen=True)
+class XvfbHandle:
+    """A picklable reference to a running display, from ``Xvfb.handle()``.
+
+    It only holds the display number, so it can be passed to
+    ``multiprocessing`` or ``ProcessPoolExecutor`` workers. Workers run
+    programs in the display, but can't stop or unlock it.
+    """
+
+    display: int
+
+    @property
+    def display_name(self) -> str:
+        return f":{self.display}"
+
+    def env(self) -> dict[str, str]:
+        """Return a copy of this process's environment, using the display."""
+        return dict(os.environ, DISPLAY=self.display_name)
+
+
+@dataclass(frozen=True)
+class XvfbCapabilities:
+    """What an installed X server binary supports, from ``probe_xvfb()``.
+
+    ``version`` is the first line of its ``-version`` output (i.e.
+    ``"X.Org X Server 1.21.1.7"``), and ``options`` are the command line
+    options listed by ``-help`` (i.e. ``"-displayfd"``).
+    """
+
+    path: str
+    version: str | None
+    options: frozenset[str]
+
+    def supports(self, option: str) -> bool:
+        """Check whether the server accepts a command line option."""
+        return option in self.options
+
+
+def find_xvfb(binary: str = "Xvfb") -> str | None:
+    """Return the path of an X server binary on PATH, or None if missing.
+
+    Successful lookups are cached for the process, for each binary and
+    PATH value. A binary that is missing is searched for again next time,
+    so it is found once it has been installed.
+    """
+    return _which(binary, os.environ.get("PATH"))
+
+
+# Paths of binaries found by _which(), by binary and PATH value
+_which_cache: dict[tuple[str, str | None], str] = {}
+
+
+def _which(binary: str, search_path: str | None) -> str | None:
+    path = _which_cache.get((binary, search_path))
+    if path is None:
+        path = shutil.which(binary, path=search_path)
+        if path is not None:
+            _which_cache[binary, search_path] = path
+    return path
+
+
+def probe_xvfb(binary: str = "Xvfb") -> XvfbCapabilities:
+    """Find out which version and options of an X server are installed.
+
+    The server is run with ``-help`` and ``-version`` only the first time a
+    binary is probed. Results are cached until the binary is replaced.
+    Raises FileNotFoundError if the binary is not found on PATH.
+    """
+    path = find_xvfb(binary)
+    if path is None:
+        raise FileNotFoundError(f"Could not find {binary}")
+    return _probe_binary(path, Path(path).stat().st_mtime_ns)
+
+
+@functools.cache
+def _probe_binary(path: str, mtime_ns: int) -> XvfbCapabilities:  # noqa: ARG001
+    """Run a server binary to list its options (cached by path and mtime)."""
+
+    def output(option: str) -> list[str]:
+        result = subprocess.run(
+            [path, option],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            errors="replace",
+            timeout=10,
+            check=False,
+        )
+        return (result.stdout + result.stderr).splitlines()
+
+    options = set()
+    # Usage lines look like "-displayfd fd   file descriptor to ...",
+    # or "[+-]bs ..." for options accepted with both prefixes
+    for line in output("-help"):
+        if not line.startswith(("+", "-", "[")):
+            continue
+        option = line.split(maxsplit=1)[0]
+        if option.startswith("[+-]"):
+            options |= {f"+{option[4:]}", f"-{option[4:]}"}
+        else:
+            options.add(option)
+    version = next((line.strip() for line in output("-version") if line.strip()), None)
+    return XvfbCapabilities(path=path, version=version, options=frozenset(options))
+
+
+def _memory_usage(pid: int) -> XvfbMemoryUsage:
+    """Read the memory usage of a process from /proc (Linux only)."""
+    fields = {}
+    with Path(f"/proc/{pid}/status").open() as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            # Sizes are reported as i.e. "VmRSS:     1234 kB"
+            if value.endswith(" kB\n"):
+                fields[key] = int(value.split()[0]) * 1024
+    return XvfbMemoryUsage(
+        rss=fields.get("VmRSS", 0),
+        peak_rss=fields.get("VmHWM", 0),
+        anon=fields.get("RssAnon", 0),
+        file=fields.get("RssFile", 0),
+        shmem=fields.get("RssShmem", 0),
+    )
+
+
+# XWD file header: 25 big-endian CARD32 values, followed by the window name
+_XWD_HEADER = struct.Struct(">25I")
+# Size of each colormap entry that follows the header
+_XWD_COLOR_SIZE = 12
+_XWD_LSB_FIRST = 0
+
+
+@dataclass(frozen=True)
+class XvfbFramebuffer:
+    """Screen contents of a running Xvfb, mapped from its -fbdir file.
+
+    ``pixels`` is a read-only view of the memory Xvfb draws into, so it
+    always shows the current screen and creating it copies nothing. For
+    32 bits per pixel it has the shape ``(height, width, 4)`` and can be
+    passed to ``numpy.asarray()`` directly. Channel order is given by the
+    color masks (usually BGRX).
+    """
+
+    width: int
+    height: int
+    depth: int
+    bits_per_pixel: int
+    bytes_per_line: int
+    byte_order: int
+    red_mask: int
+    green_mask: int
+    blue_mask: int
+    pixels: memoryview
+
+    def to_png(self) -> bytes:
+        """Encode the current screen contents as an RGB PNG image."""
+        rgb = self._rgb(self.pixels.tobytes(), 0, 0, self.width, self.height)
+        return b"".join(
+            (
+                _PNG_SIGNATURE,
+                _png_chunk(b"IHDR", _png_header(self.width, self.height)),
+                _png_chunk(b"IDAT", _png_data(rgb, self.width)),
+                _png_chunk(b"IEND", b""),
+            )
+        )
+
+    def _rgb(self, data: bytes, x: int, y: int, width: int, height: int) -> bytes:
+        """Convert a rectangle of a copy of ``pixels`` to packed RGB rows."""
+        if self.bits_per_pixel != 32:
+            raise ValueError(
+                f"Unsupported framebuffer format: {self.bits_per_pixel} bits per pixel"
+            )
+        start = y * self.bytes_per_line + x * 4
+        rows = b"".join(
+            data[offset : offset + width * 4]
+            for offset in range(
+                start, start + height * self.bytes_per_line, self.bytes_per_line
+            )
+        )
+        rgb = bytearray(width * height * 3)
+        for channel, mask in enumerate(
+            (self.red_mask, self.green_mask, self.blue_mask)
+        ):
+            offset = (mask.bit_length() - 8) // 8
+            if self.byte_order != _XWD_LSB_FIRST:
+                offset = 3 - offset
+            rgb[channel::3] = rows[offset::4]
+        return bytes(rgb)
+
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_header(width: int, height: int) -> bytes:
+    """IHDR chunk data of an 8 bit RGB image."""
+    return struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+
+
+def _png_data(rgb: bytes, width: int) -> bytes:
+    """Compress packed RGB rows into PNG image data."""
+    stride = width * 3
+    # Each PNG scanline starts with a filter type byte (0 is none)
+    scanlines = b"".join(
+        b"\x00" + rgb[offset : offset + stride] for offset in range(0, len(rgb), stride)
+    )
+    return zlib.compress(scanlines)
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def _mmap_xwd(path: Path, size: tuple[int, int] | None = None) -> XvfbFramebuffer:
+    """Memory-map an XWD framebuffer file written by Xvfb -fbdir.
+
+    ``size`` is the current size of the screen, if it was changed with
+    RandR. The file header keeps the size the server was started with,
+    and rows keep their original length.
+    """
+    with path.open("rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    fields = _XWD_HEADER.unpack_from(mapping)
+    header_size, depth, width, height = fields[0], fields[3], fields[4], fields[5]
+    if size is not None:
+        width, height = min(size[0], width), min(size[1], height)
+    byte_order, bits_per_pixel, bytes_per_line = fields[7], fields[11], fields[12]
+    red_mask, green_mask, blue_mask, ncolors = fields[14:17] + fields[19:20]
+    offset = header_size + ncolors * _XWD_COLOR_SIZE
+    pixels = memoryview(mapping)[offset : offset + height * bytes_per_line]
+    if bits_per_pixel == 32 and bytes_per_line == width * 4:
+        pixels = pixels.cast("B", (height, width, 4))
+    return XvfbFramebuffer(
+        width=width,
+        height=height,
+        depth=depth,
+        bits_per_pixel=bits_per_pixel,
+        bytes_per_line=bytes_per_line,
+        byte_order=byte_order,
+        red_mask=red_mask,
+        green_mask=green_mask,
+        blue_mask=blue_mask,
+        pixels=pixels,
+    )
+
+
+@dataclass(frozen=True)
+class XvfbFrame:
+    """A change of the screen, captured by ``Xvfb.stream_frames()``.
+
+    Only the rectangle that changed since the previous frame is kept, and
+    ``rgb`` holds its pixels as packed RGB rows. The first frame covers
+    the whole screen. ``timestamp`` is in seconds since streaming started.
+    """
+
+    timestamp: float
+    x: int
+    y: int
+    width: int
+    height: int
+    rgb: bytes
+
+
+def _stream_frames(
+    framebuffer: XvfbFramebuffer, fps: float, stop: threading.Event | None = None
+) -> Iterator[XvfbFrame]:
+    """Poll a framebuffer ``fps`` times a second, yielding what changed.
+
+    Ticks that are missed because the consumer is slow are skipped.
+    Stops when the ``stop`` event is set.
+    """
+    interval = 1 / fps
+    start = tick = time.monotonic()
+    previous = None
+    while stop is None or not stop.is_set():
+        timestamp = time.monotonic() - start
+        current = framebuffer.pixels.tobytes()
+        region: tuple[int, int, int, int] | None
+        if previous is None:
+            region = (0, 0, framebuffer.width, framebuffer.height)
+        else:
+            region = _changed_region(framebuffer, previous, current)
+        if region is not None:
+            x, y, width, height = region
+            rgb = framebuffer._rgb(current, x, y, width, height)
+            yield XvfbFrame(timestamp, x, y, width, height, rgb)
+        previous = current
+        tick += interval
+        delay = tick - time.monotonic()
+        if delay < 0:
+            tick = time.monotonic()
+        elif stop is None:
+            time.sleep(delay)
+        else:
+            stop.wait(delay)
+
+
+# Number of bytes compared at a time when finding changed columns
+_DIFF_CHUNK = 64
+
+
+def _changed_region(
+    framebuffer: XvfbFramebuffer, previous: bytes, current: bytes
+) -> tuple[int, int, int, int] | None:
+    """Return the bounding box (x, y, width, height) of changed pixels."""
+    if previous == current:
+        return None
+    bytes_per_line = framebuffer.bytes_per_line
+    row_size = framebuffer.width * 4
+    left, right = row_size, 0
+    rows = []
+    for y in range(framebuffer.height):
+        start = y * bytes_per_line
+        old, new = previous[start : start + row_size], current[start : start + row_size]
+        if old == new:
+            continue
+        rows.append(y)
+        # Narrow down to the changed columns a chunk at a time, which is
+        # much faster than comparing pixels one by one in Python
+        low = 0
+        while (
+            low < left and old[low : low + _DIFF_CHUNK] == new[low : low + _DIFF_CHUNK]
+        ):
+            low += _DIFF_CHUNK
+        high = row_size
+        while high > right:
+            next_high = max(high - _DIFF_CHUNK, 0)
+            if old[next_high:high] != new[next_high:high]:
+                break
+            high = next_high
+        left, right = min(left, low), max(right, high)
+    left, right = left // 4, min(right, row_size) // 4
+    return left, rows[0], right - left, rows[-1] + 1 - rows[0]
+
+
+class XvfbRecorder:
+    """Record the changes of a screen in a background thread.
+
+    Frames are only kept when the screen changes, and only for the
+    changed rectangle. Memory is bounded by ``max_bytes``: when recorded
+    frames exceed it, the oldest ones are merged into the first frame, so
+    the recording keeps the most recent changes. Created and started by
+    ``Xvfb.record()``, and used as a context manager.
+    """
+
+    def __init__(
+        self,
+        framebuffer: XvfbFramebuffer,
+        fps: float = 10,
+        max_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        if fps <= 0:
+            raise ValueError(f"Frames per second must be positive: {fps}")
+        self.fps: float = fps
+        self.max_bytes: int = max_bytes
+        self._framebuffer: XvfbFramebuffer = framebuffer
+        # The screen at the start of the recording, as packed RGB rows
+        self._keyframe: bytearray | None = None
+        self._keyframe_time: float = 0.0
+        self._frames: deque[XvfbFrame] = deque()
+        self._frames_size: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._stop: threading.Event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self) -> "XvfbRecorder":
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Start recording, discarding any previous recording."""
+        if self._thread is not None:
+            return
+        self.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="XvfbRecorder", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop recording, keeping the recorded frames."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def clear(self) -> None:
+        """Discard the recorded frames (i.e. when a test passed)."""
+        with self._lock:
+            self._keyframe = None
+            self._frames.clear()
+            self._frames_size = 0
+
+    @property
+    def frame_count(self) -> int:
+        """Number of frames in the recording."""
+        with self._lock:
+            return len(self._frames) + (self._keyframe is not None)
+
+    def to_apng(self) -> bytes:
+        """Encode the recording as an animated PNG image.
+
+        Frames after the first one only contain the rectangle that
+        changed, so the image stays small for mostly static screens.
+        """
+        with self._lock:
+            if self._keyframe is None:
+                raise RuntimeError("Nothing was recorded")
+            width, height = self._framebuffer.width, self._framebuffer.height
+            frames = [
+                XvfbFrame(
+                    self._keyframe_time, 0, 0, width, height, bytes(self._keyframe)
+                ),
+                *self._frames,
+            ]
+        chunks = [
+            _PNG_SIGNATURE,
+            _png_chunk(b"IHDR", _png_header(width, height)),
+            # Number of frames, and 0 to loop forever
+            _png_chunk(b"acTL", struct.pack(">II", len(frames), 0)),
+        ]
+        sequence = 0
+        for index, frame in enumerate(frames):
+            if index + 1 < len(frames):
+                delay = frames[index + 1].timestamp - frame.timestamp
+            else:
+                delay = 1 / self.fps
+            # Delays are in milliseconds, and each frame is drawn over the
+            # previous one (dispose and blend operations 0)
+            frame_control = struct.pack(
+                ">IIIIIHHBB",
+                sequence,
+                frame.width,
+                frame.height,
+                frame.x,
+                frame.y,
+                min(round(delay * 1000), 0xFFFF),
+                1000,
+                0,
+                0,
+            )
+            chunks.append(_png_chunk(b"fcTL", frame_control))
+            data = _png_data(frame.rgb, frame.width)
+            if index == 0:
+                chunks.append(_png_chunk(b"IDAT", data))
+                sequence += 1
+            else:
+                chunks.append(
+                    _png_chunk(b"fdAT", struct.pack(">I", sequence + 1) + data)
+                )
+                sequence += 2
+        chunks.append(_png_chunk(b"IEND", b""))
+        return b"".join(chunks)
+
+    def save(self, path: Path | str) -> None:
+        """Save the recording to a file as an animated PNG image."""
+        Path(path).write_bytes(self.to_apng())
+
+    def _run(self) -> None:
+        for frame in _stream_frames(self._framebuffer, self.fps, self._stop):
+            with self._lock:
+                if self._keyframe is None:
+                    self._keyframe = bytearray(frame.rgb)
+                    self._keyframe_time = frame.timestamp
+                    continue
+                self._frames.append(frame)
+                self._frames_size += len(frame.rgb)
+                while self._frames and self._frames_size > self.max_bytes:
+                    self._merge_oldest_frame()
+
+    def _merge_oldest_frame(self) -> None:
+        """Draw the oldest frame onto the keyframe, and drop it."""
+        assert self._keyframe is not None
+        frame = self._frames.popleft()
+        self._frames_size -= len(frame.rgb)
+        stride, row_size = self._framebuffer.width * 3, frame.width * 3
+        for row in range(frame.height):
+            offset = (frame.y + row) * stride + frame.x * 3
+            self._keyframe[offset : offset + row_size] = frame.rgb[
+                row * row_size : (row + 1) * row_size
+            ]
+        self._keyframe_time = frame.timestamp
+
+
+class _XConnection:
+    """Minimal X11 protocol client for managing a display.
+
+    Only implements the few requests that ``Xvfb.reset()`` and
+    ``Xvfb.resize()`` need, so no X library is required. Connects without
+    authorization, the way Xvfb accepts local connections by default.
+    """
+
+    # Core protocol opcodes
+    QUERY_TREE = 15
+    INTERN_ATOM = 16
+    DELETE_PROPERTY = 19
+    LIST_PROPERTIES = 21
+    SET_SELECTION_OWNER = 22
+    GET_INPUT_FOCUS = 43
+    QUERY_EXTENSION = 98
+    KILL_CLIENT = 113
+    # X-Resource extension minor opcode
+    XRES_QUERY_CLIENTS = 1
+    # RANDR extension minor opcodes
+    RR_QUERY_VERSION = 0
+    RR_GET_SCREEN_SIZE_RANGE = 6
+    RR_SET_SCREEN_SIZE = 7
+    RR_GET_SCREEN_RESOURCES = 8
+    RR_CREATE_MODE = 16
+    RR_ADD_OUTPUT_MODE = 18
+    RR_SET_CRTC_CONFIG = 21
+
+    def __init__(self, address: Path | str, timeout: float) -> None:
+        self._socket: socket.socket = socket.socket(socket.AF_UNIX)
+        self._socket.settimeout(timeout)
+        try:
+            setup = self._connect(address)
+        except BaseException:
+            self._socket.close()
+            raise
+        self._sequence: int = 0
+        self.resource_base: int = struct.unpack_from("<I", setup, 4)[0]
+        vendor_length, _, screen_count, format_count = struct.unpack_from(
+            "<HHBB", setup, 16
+        )
+        offset = 32 + _pad4(vendor_length) + 8 * format_count
+        self.roots: list[int] = []
+        for _ in range(screen_count):
+            self.roots.append(struct.unpack_from("<I", setup, offset)[0])
+            depth_count = setup[offset + 39]
+            offset += 40
+            for _ in range(depth_count):
+                visual_count = struct.unpack_from("<H", setup, offset + 2)[0]
+                offset += 8 + 24 * visual_count
+
+    def _connect(self, address: Path | str) -> bytes:
+        """Connect to the server and return its connection setup data.
+
+        ``address`` is a socket path, or a Linux abstract socket address
+        starting with a null byte.
+        """
+        self._socket.connect(str(address))
+        # Little-endian, protocol version 11.0, no authorization
+        self._socket.sendall(struct.pack("<BxHHHHxx", 0x6C, 11, 0, 0, 0))
+        status, _, _, _, length = struct.unpack("<BBHHH", self._recv(8))
+        setup = self._recv(length * 4)
+        if status != 1:
+            raise RuntimeError(f"X server refused connection: {setup!r}")
+        return setup
+
+    def __enter__(self) -> "_XConnection":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self._socket.close()
+
+    def _recv(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise RuntimeError("X server closed the connection")
+            data += chunk
+        return data
+
+    def send(self, opcode: int, data: bytes = b"", detail: int = 0) -> int:
+        """Send a request, returning its sequence number."""
+        data += b"\0" * (_pad4(len(data)) - len(data))
+        header = struct.pack("<BBH", opcode, detail, 1 + len(data) // 4)
+        self._socket.sendall(header + data)
+        self._sequence = (self._sequence + 1) & 0xFFFF
+        return self._sequence
+
+    def _read(self) -> tuple[int, int, int, bytes]:
+        """Read a reply, error or event: its kind, code, sequence and data."""
+        message = self._recv(32)
+        kind, code, sequence, length = struct.unpack_from("<BBHI", message)
+        if kind == 1:
+            message += self._recv(length * 4)
+        return kind, code, sequence, message
+
+    def reply(self, sequence: int) -> bytes:
+        """Read the reply to a request, skipping errors of earlier requests."""
+        while True:
+            kind, code, message_sequence, message = self._read()
+            if message_sequence != sequence:
+                continue
+            if kind == 0:
+                raise RuntimeError(f"X request failed with error {code}")
+            if kind == 1:
+                return message
+
+    def check(self, sequence: int) -> None:
+        """Wait for a request that has no reply, raising if it failed."""
+        sync = self.send(self.GET_INPUT_FOCUS)
+        while True:
+            kind, code, message_sequence, _ = self._read()
+            if kind == 0 and message_sequence == sequence:
+                raise RuntimeError(f"X request failed with error {code}")
+            if kind == 1 and message_sequence == sync:
+                return
+
+    def sync(self) -> None:
+        """Wait until the server has processed every request sent so far."""
+        self.reply(self.send(self.GET_INPUT_FOCUS))
+
+    def intern_atom(self, name: str, only_if_exists: bool = False) -> int:
+        encoded = name.encode()
+        data = struct.pack("<HH", len(encoded), 0) + encoded
+        reply = self.reply(self.send(self.INTERN_ATOM, data, int(only_if_exists)))
+        return int(struct.unpack_from("<I", reply, 8)[0])
+
+    def query_extension(self, name: str) -> int | None:
+        """Return the major opcode of an extension, or None if it is missing."""
+        encoded = name.encode()
+        data = struct.pack("<HH", len(encoded), 0) + encoded
+        reply = self.reply(self.send(self.QUERY_EXTENSION, data))
+        return reply[9] if reply[8] else None
+
+    def client_resource_bases(self) -> list[int]:
+        """Return a resource id of every connected client.
+
+        Uses the X-Resource extension, which lists clients even if they
+        have no windows. Without it, the owners of top-level windows are
+        returned instead.
+        """
+        opcode = self.query_extension("X-Resource")
+        if opcode is not None:
+            reply = self.reply(self.send(opcode, detail=self.XRES_QUERY_CLIENTS))
+            count = struct.unpack_from("<I", reply, 8)[0]
+            return [
+                struct.unpack_from("<I", reply, 32 + 8 * i)[0] for i in range(count)
+            ]
+        windows: list[int] = []
+        for root in self.roots:
+            reply = self.reply(self.send(self.QUERY_TREE, struct.pack("<I", root)))
+            count = struct.unpack_from("<H", reply, 16)[0]
+            windows += struct.unpack_from(f"<{count}I", reply, 32)
+        return windows
+
+    def list_properties(self, window: int) -> list[int]:
+        reply = self.reply(self.send(self.LIST_PROPERTIES, struct.pack("<I", window)))
+        count = struct.unpack_from("<H", reply, 8)[0]
+        return list(struct.unpack_from(f"<{count}I", reply, 32))
+
+    def set_screen_size(self, root: int, width: int, height: int) -> None:
+        """Change the size of a screen with RandR 1.2, like ``xrandr``.
+
+        The screen's output is switched to a mode of the new size, which
+        is created if needed. Raises ValueError if the size is outside the
+        range the screen supports.
+        """
+        opcode = self.query_extension("RANDR")
+        if opcode is None:
+            raise RuntimeError("X server does not support the RANDR extension")
+        # Clients must tell the server which version they implement first
+        self.reply(self.send(opcode, struct.pack("<II", 1, 2), self.RR_QUERY_VERSION))
+        window = struct.pack("<I", root)
+        reply = self.reply(self.send(opcode, window, self.RR_GET_SCREEN_SIZE_RANGE))
+        min_width, min_height, max_width, max_height = struct.unpack_from(
+            "<4H", reply, 8
+        )
+        if not (min_width <= width <= max_width and min_height <= height <= max_height):
+            raise ValueError(
+                f"Screen size {width}x{height} is outside the supported range "
+                f"{min_width}x{min_height} to {max_width}x{max_height}"
+            )
+        reply = self.reply(self.send(opcode, window, self.RR_GET_SCREEN_RESOURCES))
+        config_time, crtc_count, output_count, mode_count = struct.unpack_from(
+            "<4xIHHH", reply, 8
+        )
+        crtcs = struct.unpack_from(f"<{crtc_count}I", reply, 32)
+        outputs = struct.unpack_from(f"<{output_count}I", reply, 32 + 4 * crtc_count)
+        name = f"{width}x{height}".encode()
+        mode = self._find_mode(
+            reply, 32 + 4 * (crtc_count + output_count), mode_count, name
+        )
+        size = struct.pack("<IHH", root, width, height)
+        # Physical size of the screen at 96 DPI
+        millimeters = struct.pack(
+            "<II", max(round(width * 25.4 / 96), 1), max(round(height * 25.4 / 96), 1)
+        )
+        if not crtcs or not outputs:
+            self.check(self.send(opcode, size + millimeters, self.RR_SET_SCREEN_SIZE))
+            return
+        if mode is None:
+            # Xvfb ignores timings, but clients expect a sane refresh rate
+            mode_info = struct.pack(
+                "<IHHIHHHHHHHHI",
+                0,
+                width,
+                height,
+                min(width * height * 60, 0xFFFFFFFF),
+                *(width, width, width, 0),
+                *(height, height, height),
+                len(name),
+                0,
+            )
+            reply = self.reply(
+                self.send(opcode, window + mode_info + name, self.RR_CREATE_MODE)
+            )
+            mode = struct.unpack_from("<I", reply, 8)[0]
+        self.check(
+            self.send(
+                opcode, struct.pack("<II", outputs[0], mode), self.RR_ADD_OUTPUT_MODE
+            )
+        )
+        # The screen must contain every CRTC, so switch the CRTC off while
+        # the screen is resized
+        self._set_crtc_config(opcode, crtcs[0], config_time, 0, ())
+        self.check(self.send(opcode, size + millimeters, self.RR_SET_SCREEN_SIZE))
+        self._set_crtc_config(opcode, crtcs[0], config_time, mode, (outputs[0],))
+
+    @staticmethod
+    def _find_mode(reply: bytes, offset: int, count: int, name: bytes) -> int | None:
+        """Find a mode by name in a RandR GetScreenResources reply."""
+        names_offset = offset + 32 * count
+        for index in range(count):
+            mode_id = struct.unpack_from("<I", reply, offset + 32 * index)[0]
+            name_length = struct.unpack_from("<H", reply, offset + 32 * index + 26)[0]
+            if reply[names_offset : names_offset + name_length] == name:
+                return int(mode_id)
+            names_offset += name_length
+        return None
+
+    def _set_crtc_config(
+        self,
+        opcode: int,
+        crtc: int,
+        config_time: int,
+        mode: int,
+        outputs: Sequence[int],
+    ) -> None:
+        data = struct.pack("<IIIhhIHxx", crtc, 0, config_time, 0, 0, mode, 1)
+        data += struct.pack(f"<{len(outputs)}I", *outputs)
+        reply = self.reply(self.send(opcode, data, self.RR_SET_CRTC_CONFIG))
+        if reply[1] != 0:
+            raise RuntimeError(f"RandR could not configure CRTC (status {reply[1]})")
+
+
+def _pad4(size: int) -> int:
+    return (size + 3) & ~3
+
+
+# Running Xvfb instances, in the order they were started
+_running: list["Xvfb"] = []
+_running_lock: threading.Lock = threading.Lock()
+
+
+def _after_fork_in_child() -> None:
+    """Forget the parent's servers, so stop_all() in a child leaves them alone."""
+    global _running_lock  # noqa: PLW0603
+    # The lock may have been held by another thread of the parent
+    _running_lock = threading.Lock()
+    _running.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def stop_all(timeout: float | None = None) -> None:
+    """Stop every running Xvfb instance in parallel.
+
+    All servers are sent SIGTERM at once and reaped together, so the time
+    taken is bounded by the slowest server rather than the sum. Servers
+    that are still running after ``timeout`` seconds (by default, the
+    longest grace period of the instances) are killed.
+
+    Servers owned by an ``XvfbPool`` are left alone (close the pool
+    instead), and so are ``AsyncXvfb`` servers, which must be stopped
+    from their event loop.
+    """
+    with _running_lock:
+        xvfbs = _running[::-1]
+    if not xvfbs:
+        return
+    if timeout is None:
+        timeout = max(xvfb._grace_period for xvfb in xvfbs)
+    monitor_threads = [xvfb._detach_monitor() for xvfb in xvfbs]
+    for xvfb in xvfbs:
+        xvfb._send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for xvfb in xvfbs:
+        if xvfb.proc is not None:
+            with suppress(subprocess.TimeoutExpired):
+                xvfb.proc.wait(max(deadline - time.monotonic(), 0))
+    for xvfb in xvfbs:
+        if xvfb.proc is not None and xvfb.proc.poll() is None:
+            xvfb._send_signal(signal.SIGKILL)
+    # Every server has exited or been killed, so this only reaps them
+    # and cleans up, in reverse start order to restore DISPLAY properly
+    for xvfb in xvfbs:
+        xvfb.stop()
+    for thread in monitor_threads:
+        Xvfb._join_monitor(thread)
+
+
+# Directory where local X servers create their sockets
+_X11_SOCKET_DIR = "/tmp/.X11-unix"
+
+
+def _abstract_socket_address(display: int) -> str | None:
+    """Linux abstract socket address X servers also listen on.
+
+    The name is always based on the standard socket directory. Abstract
+    sockets belong to the network namespace instead of the filesystem,
+    so they can be reached even when the socket directory can't (i.e.
+    from a container with a private /tmp).
+    """
+    if sys.platform != "linux":
+        return None
+    return f"\0{_X11_SOCKET_DIR}/X{display}"
+
+
+def _accepts_connections(address: str) -> bool:
+    """Check if a Unix domain socket is listening, by connecting to it."""
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(address)
+        except OSError:
+            return False
+    return True
+
+
+def _x11_socket_exists(display: int, socket_dir: Path | str) -> bool:
+    """Check if an X server has, or had, a socket for a display."""
+    if Path(socket_dir, f"X{display}").exists():
+        return True
+    address = _abstract_socket_address(display)
+    return address is not None and _accepts_connections(address)
+
+
+def cleanup_stale(
+    tempdir: Path | str | None = None, socket_dir: Path | str | None = None
+) -> list[Path]:
+    """Delete display lock files left behind by crashed processes.
+
+    A lock file is stale if no process holds a lock on it, no X server
+    is listening on its display, and it doesn't name a running process
+    (X servers write their pid to lock files in /tmp). Stale files are
+    reused when their display is allocated again, so this is only needed
+    to keep long-lived temp directories tidy.
+
+    Returns the paths of the deleted files.
+    """
+    removed = []
+    for path in sorted(Path(tempdir or tempfile.gettempdir()).glob(".X*-lock")):
+        display = path.name[2:-5]
+        if not display.isdigit() or _x11_socket_exists(
+            int(display), socket_dir or _X11_SOCKET_DIR
+        ):
+            continue
+        try:
+            lock_file = path.open("r")
+        except OSError:
+            continue
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            pid = lock_file.read(11).strip()
+            if (pid.isdigit() and _pid_exists(int(pid))) or not _is_same_file(
+                lock_file, path
+            ):
+                continue
+            # Deleted while locked, like Xvfb._cleanup_lock_file()
+            with suppress(OSError):
+                path.unlink()
+                removed.append(path)
+    return removed
+
+
+def _is_same_file(f: TextIO, path: Path) -> bool:
+    """Check that an open file is still the one found at path."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+    return os.path.samestat(os.fstat(f.fileno()), stat)
+
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
 class Xvfb:
     # Maximum value to use for a display. 32-bit maxint is the
     # highest Xvfb currently supports
     MAX_DISPLAY: int = 2147483647
+    # Values the X server accepts for -maxclients
+    MAX_CLIENTS_CHOICES: tuple[int, ...] = (64, 128, 256, 512, 1024, 2048)
+    # Number of bytes of Xvfb output kept for diagnostics
+    OUTPUT_BUFFER_SIZE: int = 64 * 1024
 
     def __init__(
         self,
@@ -40,22 +1018,70 @@ class Xvfb:
         environ: MutableMapping[str, str] | None = None,
         extra_args: Sequence[str] | None = None,
         timeout: float = 10,
+        use_displayfd: bool | None = False,
+        isolate_environ: bool = False,
+        display_range: range | None = None,
+        grace_period: float | None = None,
+        process_group: bool = False,
+        metrics_callback: Callable[[str, "Xvfb"], None] | None = None,
+        fbdir: Path | str | None = None,
+        restart_on_crash: bool = False,
+        crash_callback: Callable[["Xvfb", int], None] | None = None,
+        screens: int = 1,
+        disable_extensions: Sequence[str] = (),
+        backing_store: bool | None = None,
+        max_clients: int | None = None,
+        shmem: bool = False,
+        xvfb_binary: str = "Xvfb",
+        max_width: int | None = None,
+        max_height: int | None = None,
+        socket_dir: Path | str | None = None,
         **kwargs: str,
     ) -> None:
         self.width: int = width
         self.height: int = height
         self.colordepth: int = colordepth
         self._tempdir: Path | str = tempdir or tempfile.gettempdir()
+        # Where display sockets are found, if not in the standard place
+        # (i.e. a socket directory mounted into a container)
+        self._socket_dir: Path | str = socket_dir or _X11_SOCKET_DIR
         self._timeout: float = timeout
+        # Time to wait after SIGTERM before escalating to SIGKILL
+        self._grace_period: float = timeout if grace_period is None else grace_period
+        self._process_group: bool = process_group
+        # Servers owned by an XvfbPool are stopped by the pool, not stop_all()
+        self._stop_with_all: bool = True
+        # None selects -displayfd when the server supports it, on start
+        self._use_displayfd: bool | None = use_displayfd
+        # X server to run: "Xvfb", or a compatible one (i.e. "Xvnc")
+        self._xvfb_binary: str = xvfb_binary
         self.new_display: int | None = display
-        self.environ: MutableMapping[str, str] = environ or os.environ
+        # Screens are created at the maximum size, and shrunk with RandR
+        # after starting, so resize() can make them larger again
+        self._max_size: tuple[int, int] = (max_width or width, max_height or height)
+        self._validate_arguments(
+            display_range=display_range,
+            screens=screens,
+            size=(width, height),
+            max_size=self._max_size,
+        )
+        self._display_range: range | None = display_range
+        self.environ: MutableMapping[str, str]
+        if isolate_environ:
+            # Work on a private copy so global state is never modified
+            self.environ = dict(os.environ if environ is None else environ)
+        else:
+            self.environ = environ or os.environ
 
         if set_xdg_session_type:
-            os.environ["XDG_SESSION_TYPE"] = "x11"
+            if isolate_environ:
+                self.environ["XDG_SESSION_TYPE"] = "x11"
+            else:
+                os.environ["XDG_SESSION_TYPE"] = "x11"
 
         if not self._xvfb_exists():
             raise FileNotFoundError(
-                "Could not find Xvfb. Please install it and try again"
+                f"Could not find {xvfb_binary}. Please install it and try again"
             )
 
         self.xvfb_cmd: list[str] = []
@@ -63,12 +1089,33 @@ class Xvfb:
         if not extra_args:
             extra_args = []
 
+        self.screens: int = screens
+        # Screens handed out by acquire_screen()
+        self._screens_in_use: set[int] = set()
+        self._screens_lock: threading.Lock = threading.Lock()
+        # Current size of each screen, changed by resize()
+        self._screen_sizes: list[tuple[int, int]] = [(width, height)] * screens
+
+        max_width, max_height = self._max_size
+        geometry = f"{max_width}x{max_height}x{self.colordepth}"
         self.extra_xvfb_args: list[str] = [
-            "-screen",
-            "0",
-            f"{self.width}x{self.height}x{self.colordepth}",
-            *extra_args,
+            arg
+            for screen in range(screens)
+            for arg in ("-screen", str(screen), geometry)
         ]
+        self.extra_xvfb_args += extra_args
+
+        # Directory where Xvfb keeps its framebuffer as a memory-mapped file
+        self._fbdir: Path | str | None = fbdir
+        if fbdir is not None:
+            self.extra_xvfb_args += ["-fbdir", str(fbdir)]
+        self.extra_xvfb_args += self._footprint_args(
+            disable_extensions=disable_extensions,
+            backing_store=backing_store,
+            max_clients=max_clients,
+            shmem=shmem,
+            fbdir=fbdir,
+        )
 
         for key, value in kwargs.items():
             self.extra_xvfb_args += [f"-{key}", value]
@@ -81,11 +1128,90 @@ class Xvfb:
 
         self.proc: subprocess.Popen[bytes] | None = None
         self._lock_display_file: TextIO | None = None
+        self.timings: XvfbTimings = XvfbTimings()
+        # Called with "start" or "stop" and this instance after each phase
+        self._metrics_callback: Callable[[str, Xvfb], None] | None = metrics_callback
+        # Crash monitoring: a background thread waits for the server to
+        # exit, and restarts it on the same display if it wasn't stopped
+        self._restart_on_crash: bool = restart_on_crash
+        self._crash_callback: Callable[[Xvfb, int], None] | None = crash_callback
+        self._monitor_thread: threading.Thread | None = None
+        self._monitor_lock: threading.RLock = threading.RLock()
+        # Process that started the server. Copies of this instance in
+        # forked children must not stop or unlock it
+        self._owner_pid: int = os.getpid()
+        # Latest output of the server, copied from its stdout and stderr
+        # pipe by a thread, so Xvfb never blocks on a full pipe
+        self._output: bytearray = bytearray()
+        self._output_lock: threading.Lock = threading.Lock()
+        self._output_thread: threading.Thread | None = None
 
     def __enter__(self) -> "Xvfb":
         self.start()
         return self
 
+    def __getstate__(self) -> None:
+        raise TypeError(
+            "Xvfb instances can't be pickled, pass Xvfb.handle() to other processes"
+        )
+
+    @staticmethod
+    def _validate_arguments(
+        *,
+        display_range: range | None,
+        screens: int,
+        size: tuple[int, int],
+        max_size: tuple[int, int],
+    ) -> None:
+        """Raise ValueError for arguments Xvfb would not accept."""
+        if display_range is not None and (
+            not display_range or display_range[0] < 0 or display_range[-1] < 0
+        ):
+            raise ValueError(f"Invalid display range: {display_range}")
+        if screens < 1:
+            raise ValueError(f"Number of screens must be at least 1: {screens}")
+        if max_size[0] < size[0] or max_size[1] < size[1]:
+            raise ValueError(
+                f"Maximum screen size {max_size[0]}x{max_size[1]} is smaller "
+                f"than {size[0]}x{size[1]}"
+            )
+
+    @classmethod
+    def _footprint_args(
+        cls,
+        *,
+        disable_extensions: Sequence[str],
+        backing_store: bool | None,
+        max_clients: int | None,
+        shmem: bool,
+        fbdir: Path | str | None,
+    ) -> list[str]:
+        """Build Xvfb arguments for options that affect its memory footprint.
+
+        Raises ValueError for values Xvfb would not accept.
+        """
+        if isinstance(disable_extensions, str):
+            disable_extensions = [disable_extensions]
+        args = []
+        for name in disable_extensions:
+            if not name or name[0] in "+-" or any(c.isspace() for c in name):
+                raise ValueError(f"Invalid extension name: {name!r}")
+            args += ["-extension", name]
+        if backing_store is not None:
+            args.append("+bs" if backing_store else "-bs")
+        if max_clients is not None:
+            if max_clients not in cls.MAX_CLIENTS_CHOICES:
+                choices = ", ".join(map(str, cls.MAX_CLIENTS_CHOICES))
+                raise ValueError(
+                    f"Invalid max_clients: {max_clients} (must be one of {choices})"
+                )
+            args += ["-maxclients", str(max_clients)]
+        if shmem:
+            if fbdir is not None:
+                raise ValueError("fbdir and shmem can't be used together")
+            args.append("-shmem")
+        return args
+
     def __exit__(
         self,
         exc_type: type[BaseException] | None,
@@ -95,60 +1221,653 @@ class Xvfb:
         self.stop()
 
     def start(self) -> None:
-        if not os.access(self._tempdir, os.W_OK):
-            raise RuntimeError(
-                f"Could not access writable temp directory: {self._tempdir}"
-            )
-        if self.new_display is not None:
-            if not self._get_lock_for_display(self.new_display):
-                raise RuntimeError(f"Could not lock display :{self.new_display}")
+        self._prepare_start()
+        launch_start = time.perf_counter()
+        if self._use_displayfd:
+            self._start_with_displayfd()
         else:
-            self.new_display = self._get_next_unused_display()
-        display_var = f":{self.new_display}"
-        self.xvfb_cmd = ["Xvfb", display_var, *self.extra_xvfb_args]
-        self.proc = subprocess.Popen(
-            self.xvfb_cmd,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            close_fds=True,
-            env=dict(self.environ),
-        )
-        start = time.time()
-        while not self._local_display_exists(self.new_display):
-            time.sleep(1e-3)
-            if time.time() - start > self._timeout:
-                self.stop()
-                raise RuntimeError(f"Xvfb display did not open: {self.xvfb_cmd}")
+            self._start_with_polling()
+        self._finish_start(launch_start)
+
+    @classmethod
+    def start_many(cls, count: int, *args: Any, **kwargs: Any) -> list["Xvfb"]:
+        """Start several displays at once, and wait for them together.
+
+        Every server is launched before waiting for any of them, so
+        starting ``count`` displays takes about as long as starting one.
+        Arguments are passed to each ``Xvfb`` instance. Either every
+        display is started, or all of them are stopped and the first
+        error is raised.
+        """
+        xvfbs = [cls(*args, **kwargs) for _ in range(count)]
+        # -displayfd pipes, by the read end
+        pipes: dict[int, Xvfb] = {}
+        try:
+            for xvfb in xvfbs:
+                xvfb._prepare_start()
+            launch_start = time.perf_counter()
+            for xvfb in xvfbs:
+                if xvfb._use_displayfd:
+                    pipes[xvfb._launch_with_displayfd()] = xvfb
+                else:
+                    xvfb.xvfb_cmd = xvfb._xvfb_command()
+                    xvfb.proc = xvfb._spawn()
+            cls._wait_for_many(xvfbs, pipes)
+            for xvfb in xvfbs:
+                xvfb._finish_start(launch_start)
+        except BaseException:
+            for xvfb in xvfbs:
+                xvfb.stop()
+                # Displays that were locked but never launched
+                xvfb._cleanup_lock_file()
+            raise
+        finally:
+            for read_fd in pipes:
+                os.close(read_fd)
+        return xvfbs
+
+    @staticmethod
+    def _wait_for_many(xvfbs: Sequence["Xvfb"], pipes: dict[int, "Xvfb"]) -> None:
+        """Wait until every launched server has opened its display.
+
+        The -displayfd pipes are watched with a single selector, and the
+        sockets of servers launched without -displayfd are polled in
+        between. Raises RuntimeError as soon as any server exits, or if
+        a display did not open in time.
+        """
+        data = dict.fromkeys(pipes, b"")
+        polled = [xvfb for xvfb in xvfbs if not xvfb._use_displayfd]
+        deadline = time.monotonic() + max(xvfb._timeout for xvfb in xvfbs)
+        with selectors.DefaultSelector() as selector:
+            for read_fd, xvfb in pipes.items():
+                selector.register(read_fd, selectors.EVENT_READ, xvfb)
+            while True:
+                polled = [xvfb for xvfb in polled if not xvfb._display_opened()]
+                if not polled and not selector.get_map():
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    pending = selector.get_map().values()
+                    waiting = [*polled, *(key.data for key in pending)]
+                    raise waiting[0]._start_error("Xvfb display did not open")
+                events = selector.select(min(remaining, 1e-3) if polled else remaining)
+                for key, _ in events:
+                    xvfb = key.data
+                    assert xvfb.proc is not None
+                    chunk = os.read(key.fd, 64)
+                    if not chunk:
+                        # Xvfb closed the pipe without reporting a
+                        # display, so it is exiting. Reap it to report why
+                        with suppress(subprocess.TimeoutExpired):
+                            xvfb.proc.wait(max(remaining, 0))
+                        raise xvfb._start_error(
+                            f"Xvfb did not start ({xvfb.proc.returncode})"
+                        )
+                    data[key.fd] += chunk
+                    if data[key.fd].endswith(b"\n"):
+                        selector.unregister(key.fd)
+                        xvfb.new_display = int(data[key.fd])
+
+    def _display_opened(self) -> bool:
+        """Check if a server launched without -displayfd is ready.
+
+        Raises XvfbError if the server exited instead.
+        """
+        assert self.proc is not None
+        assert self.new_display is not None
+        ret_code = self.proc.poll()
+        if ret_code is not None:
+            raise self._start_error(f"Xvfb did not start ({ret_code})")
+        return self._display_accepts_connections(self.new_display)
+
+    def _prepare_start(self) -> None:
+        """Reset timings and reserve a display number, before launching."""
+        self.timings = XvfbTimings()
+        self._owner_pid = os.getpid()
+        with self._output_lock:
+            self._output.clear()
+        if self._use_displayfd is None:
+            self._use_displayfd = probe_xvfb(self._xvfb_binary).supports("-displayfd")
+        lock_start = time.perf_counter()
+        self._reserve_display()
+        self.timings.lock_ms = _elapsed_ms(lock_start)
+
+    def _finish_start(self, launch_start: float) -> None:
+        """Set up a launched server once its display is ready."""
+        assert self.proc is not None
         ret_code = self.proc.poll()
         if ret_code is None:
-            self._set_display(display_var)
+            try:
+                self._apply_screen_sizes()
+            except BaseException:
+                self.stop()
+                raise
+            self.timings.ready_ms = _elapsed_ms(launch_start) - self.timings.spawn_ms
+            self._set_display(f":{self.new_display}")
+            if self._stop_with_all:
+                with _running_lock:
+                    _running.append(self)
+            if self._restart_on_crash or self._crash_callback is not None:
+                self._start_monitor()
+            self._emit_metrics("start")
         else:
             self._cleanup_lock_file()
-            raise RuntimeError(f"Xvfb did not start ({ret_code}): {self.xvfb_cmd}")
+            raise self._start_error(f"Xvfb did not start ({ret_code})")
 
     def stop(self) -> None:
+        """Stop Xvfb, killing it if it doesn't exit within the grace period."""
+        if self._forget_inherited_server():
+            return
+        monitor_thread = self._detach_monitor()
         if self.proc is None:
             return
+        shutdown_start = time.perf_counter()
         try:
-            if self.orig_display_var is None:
-                self.environ.pop("DISPLAY", None)
-            else:
-                self._set_display(self.orig_display_var)
+            self._restore_display()
 
-            with suppress(OSError):
-                self.proc.terminate()
-                self.proc.wait(self._timeout)
+            self._send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(self._grace_period)
+            except subprocess.TimeoutExpired:
+                self._send_signal(signal.SIGKILL)
+                self.proc.wait()
+            self._wait_for_output()
 
             self.proc = None
         finally:
+            with self._screens_lock:
+                self._screens_in_use.clear()
+            with _running_lock, suppress(ValueError):
+                _running.remove(self)
             self._cleanup_lock_file()
+        self._join_monitor(monitor_thread)
+        self.timings.shutdown_ms = _elapsed_ms(shutdown_start)
+        self._emit_metrics("stop")
 
-    def _xvfb_exists(self) -> bool:
-        """Check that Xvfb is available on PATH and is executable."""
-        return shutil.which("Xvfb") is not None
+    def _forget_inherited_server(self) -> bool:
+        """Let go of a server this instance was copied with by fork().
 
-    def _cleanup_lock_file(self) -> None:
-        """Delete lock files when stopping.
+        Returns True in a child process, where the server, its lock file
+        and its monitor thread belong to the parent. The child's copy of
+        the lock file descriptor is closed without unlocking it, and locks
+        that were copied in an unknown state are replaced.
+        """
+        if self._owner_pid == os.getpid():
+            return False
+        self._owner_pid = os.getpid()
+        self.proc = None
+        self._monitor_thread = None
+        self._monitor_lock = threading.RLock()
+        self._screens_lock = threading.Lock()
+        self._screens_in_use = set()
+        self._output_lock = threading.Lock()
+        self._output_thread = None
+        if self._lock_display_file is not None:
+            self._lock_display_file.close()
+            self._lock_display_file = None
+        return True
+
+    def _emit_metrics(self, event: str) -> None:
+        if self._metrics_callback is not None:
+            self._metrics_callback(event, self)
+
+    def is_alive(self) -> bool:
+        """Check that the server is running and its display socket exists."""
+        return (
+            self.proc is not None
+            and self.proc.poll() is None
+            and self.new_display is not None
+            and self._local_display_exists(self.new_display)
+        )
+
+    def _start_monitor(self) -> None:
+        thread = threading.Thread(
+            target=self._monitor, name=f"Xvfb-monitor:{self.new_display}", daemon=True
+        )
+        self._monitor_thread = thread
+        thread.start()
+
+    def _detach_monitor(self) -> threading.Thread | None:
+        """Tell the monitor thread that the coming exit is expected.
+
+        Waits for a restart in progress. Returns the monitor thread.
+        """
+        with self._monitor_lock:
+            monitor_thread, self._monitor_thread = self._monitor_thread, None
+        return monitor_thread
+
+    @staticmethod
+    def _join_monitor(monitor_thread: threading.Thread | None) -> None:
+        if (
+            monitor_thread is not None
+            and monitor_thread is not threading.current_thread()
+        ):
+            monitor_thread.join()
+
+    def _monitor(self) -> None:
+        """Wait for the server to exit, and handle it if it crashed."""
+        while True:
+            proc = self.proc
+            if proc is None:
+                return
+            self._wait_for_exit(proc)
+            with self._monitor_lock:
+                if self._monitor_thread is not threading.current_thread():
+                    # stop() was called, so this exit was expected
+                    return
+                returncode = proc.wait()
+                if self._restart_on_crash:
+                    self._restart()
+                else:
+                    self.stop()
+            if self._crash_callback is not None:
+                self._crash_callback(self, returncode)
+
+    @staticmethod
+    def _wait_for_exit(proc: subprocess.Popen[bytes]) -> None:
+        """Block until a process exits, without reaping it.
+
+        A pidfd becomes readable when the process exits, so no polling is
+        needed. Where pidfds are not available, the process is reaped by
+        waiting for it instead.
+        """
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except (AttributeError, OSError):
+            proc.wait()
+            return
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(pidfd, selectors.EVENT_READ)
+                selector.select()
+        finally:
+            os.close(pidfd)
+
+    def _restart(self) -> None:
+        """Launch a new server on the display of the one that crashed.
+
+        The display lock is still held, so the display number can't have
+        been taken by someone else. Readiness is reported through
+        -displayfd if the server supports it. Otherwise, the socket the
+        crashed server left behind is removed, and the display is polled
+        until it accepts connections. If the restart fails, the instance
+        is stopped.
+        """
+        with suppress(OSError, RuntimeError, ValueError):
+            if probe_xvfb(self._xvfb_binary).supports("-displayfd"):
+                self._start_with_displayfd()
+            else:
+                assert self.new_display is not None
+                with suppress(FileNotFoundError):
+                    self._display_socket(self.new_display).unlink()
+                self._start_with_polling()
+            self._apply_screen_sizes()
+        if self.proc is not None and self.proc.poll() is not None:
+            self.stop()
+
+    def _send_signal(self, sig: signal.Signals) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self._signal_pid(self.proc.pid, sig)
+
+    def _signal_pid(self, pid: int, sig: signal.Signals) -> None:
+        """Send a signal to Xvfb, or to its process group if it has one.
+
+        The caller must make sure the process has not been reaped yet, so
+        the pid can't have been reused by an unrelated process.
+        """
+        with suppress(OSError):
+            if self._process_group:
+                os.killpg(pid, sig)
+            else:
+                os.kill(pid, sig)
+
+    @property
+    def display_name(self) -> str | None:
+        """Display name of the running server (i.e. ``":42"``)."""
+        if self.proc is None or self.new_display is None:
+            return None
+        return f":{self.new_display}"
+
+    def env(self) -> dict[str, str]:
+        """Return a copy of the environment used to run programs in the display."""
+        return dict(self.environ)
+
+    def handle(self) -> XvfbHandle:
+        """Return a picklable reference to the display, for other processes."""
+        if self.proc is None or self.new_display is None:
+            raise RuntimeError("Xvfb is not running")
+        return XvfbHandle(self.new_display)
+
+    def popen(self, args: Sequence[str], **kwargs: Any) -> subprocess.Popen[Any]:
+        """Launch a program inside the display with ``subprocess.Popen``."""
+        kwargs.setdefault("env", self.env())
+        return subprocess.Popen(args, **kwargs)
+
+    def run(
+        self, args: Sequence[str], *, check: bool = False, **kwargs: Any
+    ) -> subprocess.CompletedProcess[Any]:
+        """Run a program inside the display with ``subprocess.run``."""
+        kwargs.setdefault("env", self.env())
+        return subprocess.run(args, check=check, **kwargs)
+
+    def reset(self) -> None:
+        """Clear client state from the display, without restarting Xvfb.
+
+        Every other X client is disconnected, and properties set on the
+        root windows are deleted. Selections (i.e. the clipboard) and
+        keyboard and pointer grabs are released along with the clients
+        that held them. The server process and display number are kept,
+        so this is much faster than a restart.
+        """
+        if self.proc is None or self.new_display is None:
+            raise RuntimeError("Xvfb is not running")
+        self._reset_display()
+
+    def _reset_display(self) -> None:
+        with self._connect() as connection:
+            # Their owners are notified with SelectionClear, before
+            # being killed
+            for name in ("PRIMARY", "SECONDARY", "CLIPBOARD"):
+                selection = connection.intern_atom(name, only_if_exists=True)
+                if selection:
+                    connection.send(
+                        connection.SET_SELECTION_OWNER,
+                        struct.pack("<III", 0, selection, 0),
+                    )
+            for resource in connection.client_resource_bases():
+                # Resource base 0 is the server itself
+                if resource not in (0, connection.resource_base):
+                    connection.send(connection.KILL_CLIENT, struct.pack("<I", resource))
+            # The keyboard layout is published by the server, so keep it
+            xkb_rules = connection.intern_atom("_XKB_RULES_NAMES", only_if_exists=True)
+            for root in connection.roots:
+                for atom in connection.list_properties(root):
+                    if atom != xkb_rules:
+                        connection.send(
+                            connection.DELETE_PROPERTY, struct.pack("<II", root, atom)
+                        )
+            connection.sync()
+
+    def resize(self, width: int, height: int, screen: int = 0) -> None:
+        """Change the size of a screen of the running display, with RandR.
+
+        Screens can't grow beyond the size the server was started with,
+        which is set with ``max_width`` and ``max_height``. Programs in
+        the display see the screen change size, like a monitor being
+        reconfigured, and don't need to be restarted.
+        """
+        if self.proc is None or self.new_display is None:
+            raise RuntimeError("Xvfb is not running")
+        if not 0 <= screen < self.screens:
+            raise ValueError(f"Invalid screen: {screen}")
+        self._resize_screen(screen, width, height)
+
+    def _resize_screen(self, screen: int, width: int, height: int) -> None:
+        with self._connect() as connection:
+            connection.set_screen_size(connection.roots[screen], width, height)
+        self._screen_sizes[screen] = (width, height)
+
+    def _apply_screen_sizes(self) -> None:
+        """Shrink screens from the maximum size the server was started with."""
+        for screen, (width, height) in enumerate(self._screen_sizes):
+            if (width, height) != self._max_size:
+                self._resize_screen(screen, width, height)
+
+    def acquire_screen(self) -> str:
+        """Reserve a free screen of the server for exclusive use.
+
+        Returns its display name (i.e. ``":42.1"``). Programs run with
+        DISPLAY set to that name only see their own screen, so one server
+        with many screens can replace many Xvfb processes.
+        """
+        if self.display_name is None:
+            raise RuntimeError("Xvfb is not running")
+        with self._screens_lock:
+            for screen in range(self.screens):
+                if screen not in self._screens_in_use:
+                    self._screens_in_use.add(screen)
+                    return f"{self.display_name}.{screen}"
+        raise RuntimeError(f"No free screen available on {self.display_name}")
+
+    def release_screen(self, display_name: str) -> None:
+        """Give back a screen reserved with ``acquire_screen()``."""
+        prefix = f"{self.display_name}."
+        screen = display_name.removeprefix(prefix)
+        with self._screens_lock:
+            if (
+                not display_name.startswith(prefix)
+                or not screen.isdigit()
+                or int(screen) not in self._screens_in_use
+            ):
+                raise ValueError(f"Screen is not in use: {display_name}")
+            self._screens_in_use.remove(int(screen))
+
+    @contextmanager
+    def screen(self) -> Iterator[str]:
+        """Reserve a screen for the duration of a ``with`` block."""
+        display_name = self.acquire_screen()
+        try:
+            yield display_name
+        finally:
+            self.release_screen(display_name)
+
+    def framebuffer(self, screen: int = 0) -> XvfbFramebuffer:
+        """Map the contents of a screen of the display into memory.
+
+        Requires the server to be started with ``fbdir``. Capturing a
+        frame this way doesn't copy anything or launch a program.
+        """
+        if self.proc is None:
+            raise RuntimeError("Xvfb is not running")
+        return self._map_framebuffer(screen)
+
+    def screenshot(self, path: Path | str | None = None, screen: int = 0) -> bytes:
+        """Capture a screen as PNG image data, optionally saved to a file."""
+        png = self.framebuffer(screen).to_png()
+        if path is not None:
+            Path(path).write_bytes(png)
+        return png
+
+    def stream_frames(self, fps: float = 10, screen: int = 0) -> Iterator[XvfbFrame]:
+        """Yield the changes of a screen, checking for them ``fps`` times a second.
+
+        Requires the server to be started with ``fbdir``. Nothing is
+        yielded while the screen doesn't change.
+        """
+        if fps <= 0:
+            raise ValueError(f"Frames per second must be positive: {fps}")
+        return _stream_frames(self.framebuffer(screen), fps)
+
+    def record(
+        self, fps: float = 10, max_bytes: int = 64 * 1024 * 1024, screen: int = 0
+    ) -> XvfbRecorder:
+        """Start recording a screen in the background.
+
+        Requires the server to be started with ``fbdir``. Stop the
+        returned recorder (or use it as a context manager) and save it as
+        an animated PNG, or clear it to throw the recording away.
+        """
+        recorder = XvfbRecorder(self.framebuffer(screen), fps, max_bytes)
+        recorder.start()
+        return recorder
+
+    def memory_usage(self) -> XvfbMemoryUsage:
+        """Report the memory used by the Xvfb process (Linux only)."""
+        if self.proc is None:
+            raise RuntimeError("Xvfb is not running")
+        return _memory_usage(self.proc.pid)
+
+    def _map_framebuffer(self, screen: int) -> XvfbFramebuffer:
+        if self._fbdir is None:
+            raise RuntimeError("Xvfb was not started with fbdir")
+        if not 0 <= screen < self.screens:
+            raise ValueError(f"Invalid screen: {screen}")
+        return _mmap_xwd(
+            Path(self._fbdir, f"Xvfb_screen{screen}"), self._screen_sizes[screen]
+        )
+
+    def _reserve_display(self) -> None:
+        """Lock the display number to use before launching Xvfb.
+
+        When -displayfd is used without a specific display or display
+        range, Xvfb chooses the display number itself, so nothing is
+        reserved here.
+        """
+        if not os.access(self._tempdir, os.W_OK):
+            raise RuntimeError(
+                f"Could not access writable temp directory: {self._tempdir}"
+            )
+        if self.new_display is not None:
+            if not self._get_lock_for_display(self.new_display):
+                raise RuntimeError(f"Could not lock display :{self.new_display}")
+        elif not self._use_displayfd or self._display_range is not None:
+            self.new_display = self._get_next_unused_display()
+
+    def _xvfb_command(self, display_fd: int | None = None) -> list[str]:
+        """Build the Xvfb command line, optionally with a -displayfd pipe."""
+        cmd = [self._xvfb_binary]
+        if self.new_display is not None:
+            cmd.append(f":{self.new_display}")
+        if display_fd is not None:
+            cmd += ["-displayfd", str(display_fd)]
+        return [*cmd, *self.extra_xvfb_args]
+
+    def _spawn(self, pass_fds: Sequence[int] = ()) -> subprocess.Popen[bytes]:
+        """Launch the Xvfb process for the current command line."""
+        spawn_start = time.perf_counter()
+        proc = subprocess.Popen(
+            self.xvfb_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            pass_fds=pass_fds,
+            start_new_session=self._process_group,
+            env=dict(self.environ),
+        )
+        self.timings.spawn_ms = _elapsed_ms(spawn_start)
+        assert proc.stdout is not None
+        self._output_thread = threading.Thread(
+            target=self._drain_output,
+            args=(proc.stdout,),
+            name="Xvfb-output",
+            daemon=True,
+        )
+        self._output_thread.start()
+        return proc
+
+    def output(self) -> str:
+        """Return the latest output of the Xvfb process.
+
+        Only the last ``OUTPUT_BUFFER_SIZE`` bytes are kept. The output of
+        a server that failed, crashed or was stopped remains available
+        until the instance is started again.
+        """
+        with self._output_lock:
+            return self._output.decode(errors="replace")
+
+    def _append_output(self, data: bytes) -> None:
+        with self._output_lock:
+            self._output += data
+            del self._output[: -self.OUTPUT_BUFFER_SIZE]
+
+    def _drain_output(self, pipe: IO[bytes]) -> None:
+        """Copy server output into the buffer, until the server exits."""
+        with pipe, suppress(OSError):
+            while chunk := os.read(pipe.fileno(), 4096):
+                self._append_output(chunk)
+
+    def _wait_for_output(self) -> None:
+        """Wait until the output of an exited server has been copied.
+
+        Programs launched by Xvfb (i.e. xkbcomp) may still hold the pipe
+        open, so this doesn't wait for long.
+        """
+        thread = self._output_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(1)
+
+    def _start_error(self, message: str) -> XvfbError:
+        self._wait_for_output()
+        return XvfbError(f"{message}: {self.xvfb_cmd}", self.output())
+
+    def _start_with_polling(self) -> None:
+        """Launch Xvfb and poll until its display accepts connections."""
+        self.xvfb_cmd = self._xvfb_command()
+        self.proc = self._spawn()
+        assert self.new_display is not None
+        start = time.time()
+        while not self._display_accepts_connections(self.new_display):
+            time.sleep(1e-3)
+            if time.time() - start > self._timeout:
+                self.stop()
+                raise self._start_error("Xvfb display did not open")
+
+    def _start_with_displayfd(self) -> None:
+        """Launch Xvfb with -displayfd and block until it reports readiness.
+
+        Xvfb writes the display number to the pipe once it is accepting
+        connections. If no display number was requested, Xvfb chooses a
+        free one itself and guards it with its own lock file, so no
+        lock is taken by xvfbwrapper in that case.
+        """
+        read_fd = self._launch_with_displayfd()
+        try:
+            display = self._wait_for_displayfd(read_fd)
+        finally:
+            os.close(read_fd)
+        if display is None:
+            assert self.proc is not None
+            if self.proc.poll() is None:
+                self.stop()
+                raise self._start_error("Xvfb display did not open")
+        else:
+            self.new_display = display
+
+    def _launch_with_displayfd(self) -> int:
+        """Launch Xvfb with a -displayfd pipe, and return its read end."""
+        read_fd, write_fd = os.pipe()
+        try:
+            self.xvfb_cmd = self._xvfb_command(write_fd)
+            try:
+                self.proc = self._spawn(pass_fds=(write_fd,))
+            finally:
+                os.close(write_fd)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        return read_fd
+
+    def _wait_for_displayfd(self, read_fd: int) -> int | None:
+        """Wait for Xvfb to write its display number to the -displayfd pipe.
+
+        Returns the display number, or None if the timeout expired or
+        Xvfb exited before becoming ready.
+        """
+        assert self.proc is not None
+        data = b""
+        deadline = time.monotonic() + self._timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(read_fd, selectors.EVENT_READ)
+            while not data.endswith(b"\n"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    return None
+                chunk = os.read(read_fd, 64)
+                if not chunk:
+                    # Xvfb closed the pipe without reporting a display,
+                    # so it is exiting. Reap it so the caller sees why.
+                    with suppress(subprocess.TimeoutExpired):
+                        self.proc.wait(max(remaining, 0))
+                    return None
+                data += chunk
+        return int(data)
+
+    def _xvfb_exists(self) -> bool:
+        """Check that Xvfb is available on PATH and is executable."""
+        return find_xvfb(self._xvfb_binary) is not None
+
+    def _cleanup_lock_file(self) -> None:
+        """Delete lock files when stopping.
 
         This gets called if the process exits safely with Xvfb.stop(),
         whether called explicitly, or by __exit__.
@@ -161,9 +1880,12 @@ class Xvfb:
         if self._lock_display_file is None:
             return
 
-        self._lock_display_file.close()
+        # Delete the file while it is still locked, so another process
+        # that opened it meanwhile sees it was deleted once it gets the lock
         with suppress(OSError):
             Path(self._lock_display_file.name).unlink()
+        self._lock_display_file.close()
+        self._lock_display_file = None
 
     def _get_lock_for_display(self, display: int) -> bool:
         """Attempt to acquire an exclusive lock for a display.
@@ -173,35 +1895,951 @@ class Xvfb:
         contains the display number for Xvfb.
         """
         tempfile_path = Path(self._tempdir, f".X{display}-lock")
-        try:
-            self._lock_display_file = tempfile_path.open("w")
-        except PermissionError:
-            return False
-        else:
+        while True:
             try:
-                fcntl.flock(self._lock_display_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                lock_file = tempfile_path.open("w")
+            except PermissionError:
+                return False
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
             except BlockingIOError:
+                lock_file.close()
                 return False
-            else:
+            if _is_same_file(lock_file, tempfile_path):
+                self._lock_display_file = lock_file
                 return True
+            # The previous owner deleted the file after we opened it, so
+            # the lock is on an orphaned inode. Try again with a new file
+            lock_file.close()
 
     def _get_next_unused_display(self) -> int:
-        """Randomly choose a display number and try to acquire a lock for it.
+        """Choose an unused display number and acquire a lock for it.
 
-        If the lock could be acquired, return the display number, otherwise
-        choose a new one.
+        If a display range was given, the shared allocator is used.
+        Otherwise, display numbers are chosen randomly until one that is
+        not used by a running X server can be locked.
         """
+        if self._display_range is not None:
+            return self._allocate_display(self._display_range)
         while True:
             rand = randint(1, self.__class__.MAX_DISPLAY)
-            if self._get_lock_for_display(rand):
+            if not self._local_display_exists(rand) and self._get_lock_for_display(
+                rand
+            ):
                 return rand
+            self.timings.lock_retries += 1
+
+    def _allocate_display(self, display_range: range) -> int:
+        """Allocate the next free display number from a range.
+
+        A cursor shared by all processes is kept in an index file in the
+        temp directory and guarded with an exclusive lock. Allocation
+        continues from the cursor, so displays handed out recently are
+        skipped without probing, and usually the first candidate is free.
+        The per-display lock files remain the source of truth, so
+        displays are freed when their owner stops or dies.
+        """
+        index_path = Path(
+            self._tempdir,
+            f".xvfbwrapper-display-index-{display_range.start}-{display_range.stop}",
+        )
+        with index_path.open("a+") as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            index_file.seek(0)
+            try:
+                cursor = display_range.index(int(index_file.read()))
+            except ValueError:
+                cursor = 0
+            for offset in range(len(display_range)):
+                position = (cursor + offset) % len(display_range)
+                display = display_range[position]
+                if self._local_display_exists(display):
+                    self.timings.lock_retries += 1
+                    continue
+                if not self._get_lock_for_display(display):
+                    self.timings.lock_retries += 1
+                    continue
+                index_file.seek(0)
+                index_file.truncate()
+                next_position = (position + 1) % len(display_range)
+                index_file.write(str(display_range[next_position]))
+                return display
+        raise RuntimeError(f"No free display available in {display_range}")
 
     def _local_display_exists(self, display: int) -> bool:
-        tempdir = "/tmp"
-        # We need read access to the real system temp directory
-        if not os.access(tempdir, os.R_OK):
-            raise RuntimeError(f"Could not access {tempdir} directory: {self._tempdir}")
-        return Path(tempdir, ".X11-unix", f"X{display}").exists()
+        return _x11_socket_exists(display, self._socket_dir)
+
+    def _display_socket(self, display: int) -> Path:
+        """Path of the Unix domain socket a local X server listens on."""
+        return Path(self._socket_dir, f"X{display}")
+
+    def _display_addresses(self, display: int) -> list[str]:
+        """Socket addresses of a display, in the order Xlib tries them."""
+        addresses = [str(self._display_socket(display))]
+        abstract_address = _abstract_socket_address(display)
+        if abstract_address is not None:
+            addresses.insert(0, abstract_address)
+        return addresses
+
+    def _display_accepts_connections(self, display: int) -> bool:
+        """Check if the X server of a display is listening.
+
+        The socket file appears before the server listens on it, so
+        connecting is the only reliable readiness check.
+        """
+        return any(
+            _accepts_connections(address)
+            for address in self._display_addresses(display)
+        )
+
+    def _connect(self) -> _XConnection:
+        """Open a protocol connection to the running display."""
+        assert self.new_display is not None
+        *addresses, last_address = self._display_addresses(self.new_display)
+        for address in addresses:
+            with suppress(OSError):
+                return _XConnection(address, self._timeout)
+        return _XConnection(last_address, self._timeout)
 
     def _set_display(self, display_var: str) -> None:
         self.environ["DISPLAY"] = display_var
+
+    def _restore_display(self) -> None:
+        if self.orig_display_var is None:
+            self.environ.pop("DISPLAY", None)
+        else:
+            self._set_display(self.orig_display_var)
+
+
+class AsyncXvfb:
+    """Run Xvfb from asyncio code without blocking the event loop.
+
+    Accepts the same arguments as ``Xvfb``, and is used as an async
+    context manager. The server is launched with
+    ``asyncio.create_subprocess_exec`` and readiness is awaited on a
+    ``-displayfd`` pipe, so many displays can be started concurrently
+    with ``asyncio.gather``.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        if kwargs.get("restart_on_crash") or kwargs.get("crash_callback"):
+            raise ValueError("AsyncXvfb does not support crash monitoring")
+        kwargs["use_displayfd"] = True
+        self.xvfb: Xvfb = Xvfb(*args, **kwargs)
+        self.proc: asyncio.subprocess.Process | None = None
+        # Copies the server output into the buffer of self.xvfb
+        self._output_task: asyncio.Task[None] | None = None
+
+    async def __aenter__(self) -> "AsyncXvfb":
+        await self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        await self.stop()
+
+    @property
+    def new_display(self) -> int | None:
+        return self.xvfb.new_display
+
+    @property
+    def environ(self) -> MutableMapping[str, str]:
+        return self.xvfb.environ
+
+    @property
+    def display_name(self) -> str | None:
+        """Display name of the running server (i.e. ``":42"``)."""
+        if self.proc is None or self.new_display is None:
+            return None
+        return f":{self.new_display}"
+
+    def env(self) -> dict[str, str]:
+        """Return a copy of the environment used to run programs in the display."""
+        return self.xvfb.env()
+
+    def handle(self) -> XvfbHandle:
+        """Return a picklable reference to the display, for other processes."""
+        if self.proc is None or self.new_display is None:
+            raise RuntimeError("Xvfb is not running")
+        return XvfbHandle(self.new_display)
+
+    @property
+    def timings(self) -> XvfbTimings:
+        return self.xvfb.timings
+
+    def framebuffer(self, screen: int = 0) -> XvfbFramebuffer:
+        """Map the contents of a screen of the display into memory."""
+        if self.proc is None:
+            raise RuntimeError("Xvfb is not running")
+        return self.xvfb._map_framebuffer(screen)
+
+    def screenshot(self, path: Path | str | None = None, screen: int = 0) -> bytes:
+        """Capture a screen as PNG image data, optionally saved to a file."""
+        png = self.framebuffer(screen).to_png()
+        if path is not None:
+            Path(path).write_bytes(png)
+        return png
+
+    def stream_frames(self, fps: float = 10, screen: int = 0) -> Iterator[XvfbFrame]:
+        """Yield the changes of a screen, checking for them ``fps`` times a second.
+
+        Requires the server to be started with ``fbdir``. Nothing is
+        yielded while the screen doesn't change.
+        """
+        if fps <= 0:
+            raise ValueError(f"Frames per second must be positive: {fps}")
+        return _stream_frames(self.framebuffer(screen), fps)
+
+    def record(
+        self, fps: float = 10, max_bytes: int = 64 * 1024 * 1024, screen: int = 0
+    ) -> XvfbRecorder:
+        """Start recording a screen in the background.
+
+        Requires the server to be started with ``fbdir``. Stop the
+        returned recorder (or use it as a context manager) and save it as
+        an animated PNG, or clear it to throw the recording away.
+        """
+        recorder = XvfbRecorder(self.framebuffer(screen), fps, max_bytes)
+        recorder.start()
+        return recorder
+
+    def memory_usage(self) -> XvfbMemoryUsage:
+        """Report the memory used by the Xvfb process (Linux only)."""
+        if self.proc is None:
+            raise RuntimeError("Xvfb is not running")
+        return _memory_usage(self.proc.pid)
+
+    def output(self) -> str:
+        """Return the latest output of the Xvfb process."""
+        return self.xvfb.output()
+
+    async def start(self) -> None:
+        xvfb = self.xvfb
+        xvfb.timings = XvfbTimings()
+        xvfb._owner_pid = os.getpid()
+        with xvfb._output_lock:
+            xvfb._output.clear()
+        lock_start = time.perf_counter()
+        # Locking the display can block, so keep it off the event loop
+        await asyncio.to_thread(xvfb._reserve_display)
+        xvfb.timings.lock_ms = _elapsed_ms(lock_start)
+        read_fd, write_fd = os.pipe()
+        try:
+            xvfb.xvfb_cmd = xvfb._xvfb_command(write_fd)
+            spawn_start = time.perf_counter()
+            try:
+                self.proc = await asyncio.create_subprocess_exec(
+                    *xvfb.xvfb_cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    pass_fds=(write_fd,),
+                    start_new_session=xvfb._process_group,
+                    env=dict(xvfb.environ),
+                )
+            finally:
+                os.close(write_fd)
+        except BaseException:
+            os.close(read_fd)
+            xvfb._cleanup_lock_file()
+            raise
+        xvfb.timings.spawn_ms = _elapsed_ms(spawn_start)
+        assert self.proc.stdout is not None
+        self._output_task = asyncio.create_task(self._drain_output(self.proc.stdout))
+        ready_start = time.perf_counter()
+        try:
+            display = await self._wait_for_displayfd(read_fd)
+        except BaseException:
+            # i.e. the task was cancelled, so don't leave the server running
+            await self.stop()
+            raise
+        if display is None:
+            if self.proc.returncode is None:
+                await self.stop()
+                raise XvfbError(
+                    f"Xvfb display did not open: {xvfb.xvfb_cmd}", xvfb.output()
+                )
+            await self._wait_for_output()
+            xvfb._cleanup_lock_file()
+            raise XvfbError(
+                f"Xvfb did not start ({self.proc.returncode}): {xvfb.xvfb_cmd}",
+                xvfb.output(),
+            )
+        xvfb.new_display = display
+        try:
+            await asyncio.to_thread(xvfb._apply_screen_sizes)
+        except BaseException:
+            await self.stop()
+            raise
+        xvfb.timings.ready_ms = _elapsed_ms(ready_start)
+        xvfb._set_display(f":{display}")
+        xvfb._emit_metrics("start")
+
+    async def stop(self) -> None:
+        """Stop Xvfb, killing it if it doesn't exit within the grace period."""
+        if self.xvfb._forget_inherited_server():
+            self.proc = None
+            self._output_task = None
+            return
+        if self.proc is None:
+            return
+        shutdown_start = time.perf_counter()
+        try:
+            self.xvfb._restore_display()
+
+            self._send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(self.proc.wait(), self.xvfb._grace_period)
+            except asyncio.TimeoutError:
+                self._send_signal(signal.SIGKILL)
+                await self.proc.wait()
+            await self._wait_for_output()
+
+            self.proc = None
+        finally:
+            self.xvfb._cleanup_lock_file()
+        self.xvfb.timings.shutdown_ms = _elapsed_ms(shutdown_start)
+        self.xvfb._emit_metrics("stop")
+
+    async def resize(self, width: int, height: int, screen: int = 0) -> None:
+        """Change the size of a screen of the running display, with RandR."""
+        if self.proc is None or self.new_display is None:
+            raise RuntimeError("Xvfb is not running")
+        if not 0 <= screen < self.xvfb.screens:
+            raise ValueError(f"Invalid screen: {screen}")
+        await asyncio.to_thread(self.xvfb._resize_screen, screen, width, height)
+
+    async def reset(self) -> None:
+        """Clear client state from the display, without restarting Xvfb."""
+        if self.proc is None:
+            raise RuntimeError("Xvfb is not running")
+        await asyncio.to_thread(self.xvfb._reset_display)
+
+    def _send_signal(self, sig: signal.Signals) -> None:
+        if self.proc is not None and self.proc.returncode is None:
+            self.xvfb._signal_pid(self.proc.pid, sig)
+
+    async def _drain_output(self, stream: asyncio.StreamReader) -> None:
+        while chunk := await stream.read(4096):
+            self.xvfb._append_output(chunk)
+
+    async def _wait_for_output(self) -> None:
+        """Wait until the output of an exited server has been copied."""
+        if self._output_task is not None:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(asyncio.shield(self._output_task), 1)
+
+    async def _wait_for_displayfd(self, read_fd: int) -> int | None:
+        """Await the display number Xvfb writes to the -displayfd pipe.
+
+        Returns None if the timeout expired or Xvfb exited before
+        becoming ready. The pipe is closed before returning.
+        """
+        assert self.proc is not None
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            os.fdopen(read_fd, "rb", buffering=0),
+        )
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.xvfb._timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            transport.close()
+        if not line.endswith(b"\n"):
+            # Xvfb closed the pipe without reporting a display, so it
+            # is exiting. Reap it so the caller sees why.
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.proc.wait(), self.xvfb._timeout)
+            return None
+        return int(line)
+
+
+class XvfbPool:
+    """Keep a number of Xvfb servers started and ready to hand out.
+
+    Servers are started by a background thread. ``acquire()`` returns an
+    already running ``Xvfb`` instance, and ``release()`` gives it back.
+    By default, released servers are not reused: each one is stopped and
+    replaced by a fresh server in the background, so every acquired
+    display starts from a clean state. With ``reset_on_release=True``,
+    released servers are cleared with ``Xvfb.reset()`` and reused
+    instead, which is much faster. Servers that can't be reset are
+    replaced.
+
+    Pooled servers are created with ``isolate_environ=True``, so acquiring
+    a display never modifies ``os.environ``. Use ``env()``, ``popen()`` or
+    ``run()`` of the acquired instance to launch programs in the display.
+
+    Keyword arguments are passed to ``Xvfb`` when creating servers, so
+    display number locking works the same as with a single ``Xvfb``.
+    """
+
+    def __init__(
+        self, size: int = 2, reset_on_release: bool = False, **kwargs: Any
+    ) -> None:
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1: {size}")
+        if "display" in kwargs:
+            raise ValueError("Pooled servers can not use a specific display")
+        if not kwargs.pop("isolate_environ", True):
+            raise ValueError("Pooled servers always use isolate_environ")
+        self.size: int = size
+        self._reset_on_release: bool = reset_on_release
+        self._environ: MutableMapping[str, str] = kwargs.pop("environ", None) or (
+            os.environ
+        )
+        self._xvfb_kwargs: dict[str, Any] = kwargs
+        # Check the arguments now, so mistakes are not only reported
+        # later from the background thread
+        Xvfb(environ=self._environ, isolate_environ=True, **kwargs)
+        # Servers (or the errors raised while starting them) ready to acquire
+        self._ready: queue.Queue[Xvfb | Exception] = queue.Queue()
+        # Work for the background thread: None requests a new server, and
+        # an Xvfb instance is a released server that needs to be recycled
+        self._tasks: queue.Queue[Xvfb | None] = queue.Queue()
+        self._in_use: set[Xvfb] = set()
+        self._lock: threading.Lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._closed: bool = False
+
+    def __enter__(self) -> "XvfbPool":
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """Start the background thread and begin filling the pool."""
+        if self._thread is not None:
+            return
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="XvfbPool", daemon=True)
+        self._thread.start()
+        for _ in range(self.size):
+            self._tasks.put(None)
+
+    def close(self) -> None:
+        """Stop every server in the pool, including ones in use."""
+        if self._thread is None:
+            return
+        self._closed = True
+        self._tasks.put(None)
+        self._thread.join()
+        self._thread = None
+        while not self._ready.empty():
+            item = self._ready.get_nowait()
+            if isinstance(item, Xvfb):
+                item.stop()
+        with self._lock:
+            in_use = list(self._in_use)
+            self._in_use.clear()
+        for xvfb in in_use:
+            xvfb.stop()
+
+    def acquire(self, timeout: float | None = None) -> Xvfb:
+        """Take a running server from the pool.
+
+        Blocks until a server is ready, or until ``timeout`` seconds have
+        passed. Errors raised while starting a server are re-raised here.
+        """
+        if self._thread is None:
+            raise RuntimeError("XvfbPool is not started")
+        try:
+            item = self._ready.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(
+                f"No Xvfb display available after {timeout} seconds"
+            ) from None
+        if isinstance(item, Exception):
+            # The failed server still occupies a slot, so try again
+            self._tasks.put(None)
+            raise item
+        with self._lock:
+            self._in_use.add(item)
+        return item
+
+    def release(self, xvfb: Xvfb) -> None:
+        """Return a server to the pool so it can be replaced."""
+        with self._lock:
+            if xvfb not in self._in_use:
+                raise ValueError(f"Xvfb display is not in use: :{xvfb.new_display}")
+            self._in_use.remove(xvfb)
+        if self._closed or self._thread is None:
+            xvfb.stop()
+        else:
+            self._tasks.put(xvfb)
+
+    @contextmanager
+    def display(self, timeout: float | None = None) -> Iterator[Xvfb]:
+        """Acquire a server for the duration of a ``with`` block."""
+        xvfb = self.acquire(timeout)
+        try:
+            yield xvfb
+        finally:
+            self.release(xvfb)
+
+    def _run(self) -> None:
+        while True:
+            task = self._tasks.get()
+            if task is not None:
+                if not self._closed and self._reset_on_release and self._reset(task):
+                    self._ready.put(task)
+                    continue
+                task.stop()
+            if self._closed:
+                if self._tasks.empty():
+                    return
+                continue
+            self._ready.put(self._launch())
+
+    @staticmethod
+    def _reset(xvfb: Xvfb) -> bool:
+        """Reset a released server for reuse, returning False if that failed."""
+        try:
+            xvfb.reset()
+        except (OSError, RuntimeError):
+            return False
+        return True
+
+    def _launch(self) -> Xvfb | Exception:
+        try:
+            xvfb = Xvfb(
+                environ=self._environ, isolate_environ=True, **self._xvfb_kwargs
+            )
+            xvfb._stop_with_all = False
+            xvfb.start()
+        except Exception as e:  # noqa: BLE001 - re-raised by acquire()
+            return e
+        return xvfb
+
+
+class XvfbDaemon:
+    """Lease displays from a pool of servers to other processes.
+
+    Clients on the same host connect to a Unix domain socket and lease a
+    running display with ``XvfbLease``, so short-lived processes share
+    warm servers instead of each starting their own. Servers are kept
+    ready by an ``XvfbPool``, which is given the keyword arguments.
+
+    A lease ends when it is released, when it is not renewed within its
+    time to live (in seconds), or when the client's connection closes,
+    which also happens if the client crashes. Released displays are
+    replaced or reset, like with ``XvfbPool``.
+
+    The protocol is one JSON object per line. Requests have an ``op`` of
+    ``"lease"`` (with an optional ``ttl``), ``"renew"`` or ``"release"``
+    (with the ``lease`` id). Responses contain the ``lease`` id, the
+    ``display`` name and the ``ttl``, or an ``error`` message.
+    """
+
+    def __init__(
+        self, socket_path: Path | str, size: int = 2, ttl: float = 60, **kwargs: Any
+    ) -> None:
+        if ttl <= 0:
+            raise ValueError(f"Lease time to live must be positive: {ttl}")
+        self.socket_path: Path = Path(socket_path)
+        self.ttl: float = ttl
+        self._pool: XvfbPool = XvfbPool(size, **kwargs)
+        # Active leases: id -> (display, expiry time)
+        self._leases: dict[str, tuple[Xvfb, float]] = {}
+        self._lease_ids: Iterator[int] = itertools.count(1)
+        self._condition: threading.Condition = threading.Condition()
+        self._server: _LeaseServer | None = None
+        self._threads: list[threading.Thread] = []
+
+    def __enter__(self) -> "XvfbDaemon":
+        self.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.close()
+
+    def start(self) -> None:
+        """Start the pool and begin serving leases in the background."""
+        if self._server is not None:
+            return
+        self._remove_stale_socket()
+        self._pool.start()
+        try:
+            self._server = _LeaseServer(self.socket_path, self)
+        except OSError:
+            self._pool.close()
+            raise
+        self._threads = [
+            threading.Thread(target=self._server.serve_forever, daemon=True),
+            threading.Thread(target=self._expire_leases, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self) -> None:
+        """Stop serving, end all leases, and stop every server."""
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.shutdown()
+        server.server_close()
+        with suppress(OSError):
+            self.socket_path.unlink()
+        with self._condition:
+            self._leases.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._pool.close()
+
+    def _remove_stale_socket(self) -> None:
+        """Remove the socket of a daemon that is no longer running.
+
+        Raises FileExistsError if something other than a socket exists at
+        the path, so it is never deleted.
+        """
+        try:
+            mode = self.socket_path.lstat().st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"Not a socket: {self.socket_path}")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(self.socket_path))
+            except ConnectionRefusedError:
+                self.socket_path.unlink()
+            except OSError:
+                pass
+
+    def _handle_request(self, request: dict[str, Any], leases: set[str]) -> Any:
+        """Handle one request from a client holding ``leases``."""
+        op = request.get("op")
+        if op == "lease":
+            ttl = float(request.get("ttl") or self.ttl)
+            if ttl <= 0:
+                raise ValueError(f"Lease time to live must be positive: {ttl}")
+            xvfb = self._pool.acquire(request.get("timeout"))
+            lease_id = str(next(self._lease_ids))
+            with self._condition:
+                self._leases[lease_id] = (xvfb, time.monotonic() + ttl)
+                self._condition.notify_all()
+            leases.add(lease_id)
+            return {"lease": lease_id, "display": xvfb.display_name, "ttl": ttl}
+        lease_id = str(request.get("lease"))
+        if op not in ("renew", "release"):
+            raise ValueError(f"Unknown operation: {op}")
+        with self._condition:
+            if lease_id not in leases or lease_id not in self._leases:
+                raise ValueError(f"Lease is not active: {lease_id}")
+            xvfb, _ = self._leases[lease_id]
+            if op == "renew":
+                ttl = float(request.get("ttl") or self.ttl)
+                self._leases[lease_id] = (xvfb, time.monotonic() + ttl)
+                self._condition.notify_all()
+                return {"lease": lease_id, "display": xvfb.display_name, "ttl": ttl}
+        self._end_lease(lease_id)
+        leases.discard(lease_id)
+        return {"lease": lease_id}
+
+    def _end_lease(self, lease_id: str) -> None:
+        with self._condition:
+            lease = self._leases.pop(lease_id, None)
+        if lease is not None:
+            self._pool.release(lease[0])
+
+    def _expire_leases(self) -> None:
+        """End leases that were not renewed in time, until closed."""
+        with self._condition:
+            while self._server is not None:
+                now = time.monotonic()
+                for lease_id, (_, expiry) in list(self._leases.items()):
+                    if expiry <= now:
+                        self._pool.release(self._leases.pop(lease_id)[0])
+                expiries = [expiry for _, expiry in self._leases.values()]
+                self._condition.wait(min(expiries) - now if expiries else None)
+
+
+class _LeaseServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, xvfb_daemon: XvfbDaemon) -> None:
+        self.xvfb_daemon: XvfbDaemon = xvfb_daemon
+        super().__init__(str(socket_path), _LeaseHandler)
+
+
+class _LeaseHandler(socketserver.StreamRequestHandler):
+    """Serve requests from one client connection."""
+
+    def handle(self) -> None:
+        assert isinstance(self.server, _LeaseServer)
+        xvfb_daemon = self.server.xvfb_daemon
+        # Leases held through this connection end when it closes
+        leases: set[str] = set()
+        try:
+            for line in self.rfile:
+                try:
+                    response = xvfb_daemon._handle_request(json.loads(line), leases)
+                except Exception as e:  # noqa: BLE001 - reported to the client
+                    response = {"error": str(e)}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+        finally:
+            for lease_id in leases:
+                xvfb_daemon._end_lease(lease_id)
+
+
+class XvfbLease:
+    """A display leased from an ``XvfbDaemon``.
+
+    The lease is held over a connection to the daemon's socket, so it
+    ends if this process exits. Unless ``renew()`` is called within the
+    lease's time to live (by default, the daemon's), it expires.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path | str,
+        ttl: float | None = None,
+        timeout: float | None = None,
+    ) -> None:
+        self.socket_path: Path = Path(socket_path)
+        self.ttl: float | None = ttl
+        self._timeout: float | None = timeout
+        self.lease_id: str | None = None
+        self.display_name: str | None = None
+        self._socket: socket.socket | None = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def __enter__(self) -> "XvfbLease":
+        self.acquire()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self.release()
+
+    def acquire(self) -> str:
+        """Lease a display from the daemon and return its display name."""
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(str(self.socket_path))
+            response = self._request(op="lease", ttl=self.ttl, timeout=self._timeout)
+        except BaseException:
+            self._socket.close()
+            self._socket = None
+            raise
+        self.lease_id = response["lease"]
+        self.display_name = response["display"]
+        self.ttl = response["ttl"]
+        return response["display"]
+
+    def renew(self) -> None:
+        """Extend the lease by its time to live."""
+        self._request(op="renew", lease=self.lease_id, ttl=self.ttl)
+
+    def release(self) -> None:
+        """Give the display back to the daemon."""
+        if self._socket is None:
+            return
+        try:
+            with suppress(RuntimeError):
+                # The lease may have expired already
+                self._request(op="release", lease=self.lease_id)
+        finally:
+            self._socket.close()
+            self._socket = None
+            self.lease_id = None
+            self.display_name = None
+
+    def env(self) -> dict[str, str]:
+        """Return a copy of os.environ with DISPLAY set to the leased display."""
+        if self.display_name is None:
+            raise RuntimeError("No display is leased")
+        return dict(os.environ, DISPLAY=self.display_name)
+
+    def _request(self, **request: Any) -> dict[str, Any]:
+        if self._socket is None:
+            raise RuntimeError("No display is leased")
+        with self._lock:
+            self._socket.sendall(json.dumps(request).encode() + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = self._socket.recv(4096)
+                if not chunk:
+                    raise RuntimeError("Connection to Xvfb daemon closed")
+                data += chunk
+        response: dict[str, Any] = json.loads(data)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    """Run a command inside a headless display, like ``xvfb-run``.
+
+    Returns the exit status of the command, or 128 plus the signal number
+    if it was killed by a signal. With ``--serve``, runs an ``XvfbDaemon``
+    until it receives SIGINT or SIGTERM instead.
+    """
+    parser = argparse.ArgumentParser(
+        prog="xvfbwrapper",
+        description="Run a command inside a headless Xvfb display.",
+    )
+    parser.add_argument("-W", "--width", type=int, default=800)
+    parser.add_argument("-H", "--height", type=int, default=680)
+    parser.add_argument("-d", "--colordepth", type=int, default=24)
+    parser.add_argument(
+        "-n", "--display", type=int, help="display number (default: any free one)"
+    )
+    parser.add_argument(
+        "-s", "--server-args", default="", help="extra Xvfb arguments, as one string"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="seconds to wait for Xvfb to start"
+    )
+    parser.add_argument(
+        "--displayfd",
+        action=argparse.BooleanOptionalAction,
+        help="wait for readiness with -displayfd instead of polling "
+        "(default: if the server supports it)",
+    )
+    parser.add_argument(
+        "--xvfb-binary",
+        default="Xvfb",
+        metavar="BINARY",
+        help="X server to run (default: Xvfb)",
+    )
+    parser.add_argument(
+        "--socket-dir",
+        metavar="DIR",
+        help="directory of X server sockets (default: /tmp/.X11-unix)",
+    )
+    parser.add_argument(
+        "--attach",
+        metavar="DISPLAY",
+        help="run the command in this running display instead of starting one",
+    )
+    parser.add_argument(
+        "--lease",
+        metavar="SOCKET",
+        help="run the command in a display leased from the daemon at SOCKET",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        help="run a daemon leasing displays to other processes over SOCKET",
+    )
+    parser.add_argument(
+        "--pool-size", type=int, default=2, help="displays kept ready by --serve"
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        help="seconds a lease lasts without renewal "
+        "(default: 60 for --serve, the daemon's setting for --lease)",
+    )
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    xvfb_kwargs = {
+        "width": args.width,
+        "height": args.height,
+        "colordepth": args.colordepth,
+        "extra_args": shlex.split(args.server_args),
+        "timeout": args.timeout,
+        "use_displayfd": args.displayfd,
+        "xvfb_binary": args.xvfb_binary,
+        "socket_dir": args.socket_dir,
+    }
+
+    try:
+        if args.serve is not None:
+            if args.ttl is not None:
+                xvfb_kwargs["ttl"] = args.ttl
+            _serve(XvfbDaemon(args.serve, args.pool_size, **xvfb_kwargs))
+            return 0
+        if not command:
+            parser.error("no command given")
+        if args.attach is not None:
+            return _run_command(command, dict(os.environ, DISPLAY=args.attach))
+        if args.lease is not None:
+            return _run_leased(command, XvfbLease(args.lease, args.ttl))
+        xvfb = Xvfb(display=args.display, isolate_environ=True, **xvfb_kwargs)
+        xvfb.start()
+    except (OSError, RuntimeError, ValueError) as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+    try:
+        return _run_command(command, xvfb.env())
+    finally:
+        xvfb.stop()
+
+
+def _serve(xvfb_daemon: XvfbDaemon) -> None:
+    """Run a daemon until SIGINT or SIGTERM is received."""
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+    with xvfb_daemon:
+        stopping.wait()
+
+
+def _run_leased(command: Sequence[str], lease: XvfbLease) -> int:
+    """Run a command in a leased display, renewing the lease until it exits."""
+    with lease:
+        done = threading.Event()
+
+        def renew() -> None:
+            assert lease.ttl is not None
+            while not done.wait(lease.ttl / 2):
+                lease.renew()
+
+        renew_thread = threading.Thread(target=renew, daemon=True)
+        renew_thread.start()
+        try:
+            return _run_command(command, lease.env())
+        finally:
+            done.set()
+            renew_thread.join()
+
+
+def _run_command(command: Sequence[str], env: dict[str, str]) -> int:
+    """Run a command to completion, forwarding termination signals to it."""
+    try:
+        proc = subprocess.Popen(command, env=env)
+    except OSError as e:
+        sys.stderr.write(f"xvfbwrapper: {e}\n")
+        # Same status as a shell uses for a command that can't be run
+        return 127
+
+    def forward(signum: int, _frame: object) -> None:
+        proc.send_signal(signum)
+
+    forwarded = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+    handlers = {sig: signal.signal(sig, forward) for sig in forwarded}
+    try:
+        returncode = proc.wait()
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+    return 128 - returncode if returncode < 0 else returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())